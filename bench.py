@@ -0,0 +1,406 @@
+# bench.py – load generator and latency benchmark for the bot handlers
+#
+#   python bench.py --rate 200 --users 500 --duration 10 --bot-latency 40 --db-latency 60
+#
+# Runs the real Application from "bot .py" against a fake Bot API server and
+# a fake Appwrite server (both local, with injectable latency), feeds it
+# synthetic updates at a fixed rate and reports per-handler latency and the
+# number of external calls each update costs.
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import itertools
+import importlib.util
+from collections import Counter
+from urllib.parse import parse_qsl
+
+from telegram.ext import BaseUpdateProcessor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = {
+    # name -> how to build the update for a user
+    "start":       ("command", "/start"),
+    "start_ref":   ("command", "/start {referrer}"),
+    "referral":    ("text", "💰 Referral"),
+    "check_join":  ("callback", "check_join"),
+    "invites":     ("callback", "show_invites"),
+    "menu":        ("text", "📚 UAT Preparation"),
+    "back":        ("text", "⬅ Back"),
+    "forwarder":   ("text", "🎯 Kimem Short Notes"),
+    "sphmmc":      ("text", "📝 How to Prepare For SPHMMC"),
+    "multi":       ("text", "📘 Text Books"),
+}
+
+# ------------------------------------------------------------------
+#  Fake external services
+# ------------------------------------------------------------------
+class FakeService:
+    def __init__(self, latency_ms: float, jitter_ms: float):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.calls = Counter()
+
+    async def delay(self):
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+def _ok(result):
+    return 200, "application/json", json.dumps({"ok": True, "result": result}).encode()
+
+class FakeBotApi(FakeService):
+    BOT = {"id": 1, "is_bot": True, "first_name": "bench", "username": "kimemuatbot",
+           "can_join_groups": True, "can_read_all_group_messages": False,
+           "supports_inline_queries": False}
+
+    def __init__(self, token: str, latency_ms: float, jitter_ms: float):
+        super().__init__(latency_ms, jitter_ms)
+        self.prefix = f"/bot{token}/"
+        self._next_id = 1000
+
+    def _message(self, chat_id, **extra):
+        self._next_id += 1
+        return {"message_id": self._next_id, "date": int(time.time()),
+                "chat": {"id": int(chat_id or 1), "type": "private"}, **extra}
+
+    async def handle(self, request):
+        method = request.path[len(self.prefix):]
+        self.calls[method] += 1
+        await self.delay()
+        params = {}
+        if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            params = dict(parse_qsl(request.body.decode()))
+        chat_id = params.get("chat_id")
+        if method == "getMe":
+            return _ok(self.BOT)
+        if method in ("sendMessage", "editMessageCaption"):
+            return _ok(self._message(chat_id, text=params.get("text", "")))
+        if method == "sendPhoto":
+            return _ok(self._message(chat_id, photo=[
+                {"file_id": "bench-photo", "file_unique_id": "bench", "width": 1, "height": 1}
+            ]))
+        if method == "copyMessage":
+            return _ok({"message_id": self._next_id})
+        if method == "copyMessages":
+            return _ok([{"message_id": i} for i in json.loads(params.get("message_ids", "[]"))])
+        if method == "getChatMember":
+            user = {"id": int(params.get("user_id", 1)), "is_bot": False, "first_name": "u"}
+            return _ok({"status": "member", "user": user})
+        return _ok(True)
+
+class FakeAppwrite(FakeService):
+    PATH = re.compile(r"/databases/[^/]+/collections/([^/]+)/documents(?:/([^/]+))?(?:/([^/]+)/increment)?$")
+
+    def __init__(self, latency_ms: float, jitter_ms: float):
+        super().__init__(latency_ms, jitter_ms)
+        self.collections: dict[str, dict] = {}
+
+    @staticmethod
+    def _json(status, payload):
+        return status, "application/json", json.dumps(payload).encode()
+
+    async def handle(self, request):
+        match = self.PATH.search(request.path)
+        if not match:
+            return self._json(404, {"message": "route not found"})
+        collection, doc_id, attribute = match.groups()
+        self.calls[f"{request.method} {'increment' if attribute else 'document' if doc_id else 'collection'}"] += 1
+        await self.delay()
+        docs = self.collections.setdefault(collection, {})
+        body = json.loads(request.body) if request.body else {}
+
+        if request.method == "GET" and doc_id:
+            if doc_id not in docs:
+                return self._json(404, {"message": "Document not found"})
+            return self._json(200, docs[doc_id])
+        if request.method == "GET":
+            return self._json(200, self._list(docs, request.query))
+        if request.method == "POST":
+            new_id = body["documentId"]
+            if new_id in docs:
+                return self._json(409, {"message": "Document already exists"})
+            docs[new_id] = {"$id": new_id, "$createdAt": time.time(), **body["data"]}
+            return self._json(201, docs[new_id])
+        if request.method == "PATCH" and doc_id in docs:
+            if attribute:
+                docs[doc_id][attribute] = (docs[doc_id].get(attribute) or 0) + body.get("value", 1)
+            else:
+                docs[doc_id].update(body.get("data", {}))
+            return self._json(200, docs[doc_id])
+        return self._json(404, {"message": "Document not found"})
+
+    @staticmethod
+    def _list(docs: dict, query: str) -> dict:
+        queries = [json.loads(v) for k, v in parse_qsl(query) if k == "queries[]"]
+        rows = list(docs.values())
+        limit = 25
+        for q in queries:
+            if q["method"] == "equal":
+                rows = [d for d in rows if str(d.get(q["attribute"])) in map(str, q["values"])]
+            elif q["method"] == "limit":
+                limit = q["values"][0]
+        rows.sort(key=lambda d: d["$id"])
+        total = len(rows)
+        for q in queries:
+            if q["method"] == "cursorAfter":
+                rows = [d for d in rows if d["$id"] > q["values"][0]]
+            elif q["method"] == "cursorBefore":
+                rows = [d for d in rows if d["$id"] < q["values"][0]][-limit:]
+        return {"total": total, "documents": rows[:limit]}
+
+# ------------------------------------------------------------------
+#  Loading the bot against the fakes
+# ------------------------------------------------------------------
+def load_bot(args, bot_port: int, db_port: int, workdir: str):
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCH",
+        "CHANNEL_USERNAME": "@bench_channel",
+        "DB_MAIN_CHANNEL_USERNAME": "@bench_main",
+        "DB_OTHERS_CHANNEL_USERNAME": "@bench_others",
+        "DB_BOOKS_CHANNEL_USERNAME": "@bench_books",
+        "BOT_API_URL": f"http://127.0.0.1:{bot_port}",
+        "BOT_MODE": "polling",
+        "APPWRITE_ENDPOINT": f"http://127.0.0.1:{db_port}/v1",
+        "APPWRITE_PROJECT_ID": "bench",
+        "APPWRITE_API_KEY": "bench",
+        "APPWRITE_DATABASE_ID": "bench",
+        "APPWRITE_COLLECTION_ID": "users",
+        "APPWRITE_INVITES_COLLECTION_ID": "invites",
+        "STORAGE_BACKEND": args.storage,
+        "SQLITE_PATH": os.path.join(workdir, "bench.db"),
+        "MEDIA_CACHE_PATH": os.path.join(workdir, "media_cache.json"),
+        "CONTENT_INDEX_PATH": os.path.join(workdir, "content_index.json"),
+        "STATE_PATH": os.path.join(workdir, "state.db"),
+    })
+    # Repeated synthetic uids would otherwise be dropped as duplicate taps
+    # and show up as near-zero latencies
+    os.environ["DEBOUNCE_WINDOW"] = str(args.debounce_window)
+    if args.no_rate_limit:
+        os.environ.update({"SEND_GLOBAL_RATE": "1000000", "SEND_CHAT_RATE": "1000000",
+                           "SEND_CHAT_BURST": "1000000"})
+    os.chdir(HERE)  # image assets are loaded relative to the repo
+    spec = importlib.util.spec_from_file_location("kimem_bot", os.path.join(HERE, "bot .py"))
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    # Per-request logs would dominate both the output and the timings
+    for name in ("httpx", "telegram", bot.logger.name):
+        logging.getLogger(name).setLevel(args.log_level)
+    return bot
+
+def make_update(scenario: str, update_id: int, uid: int, referrer: int) -> dict:
+    kind, payload = SCENARIOS[scenario]
+    user = {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+    chat = {"id": uid, "type": "private"}
+    now = int(time.time())
+    if kind == "callback":
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": user, "chat_instance": str(uid), "data": payload,
+            "message": {"message_id": 1, "date": now, "chat": chat,
+                        "photo": [{"file_id": "x", "file_unique_id": "x", "width": 1, "height": 1}]},
+        }}
+    text = payload.format(referrer=referrer)
+    message = {"message_id": update_id, "date": now, "chat": chat, "from": user, "text": text}
+    if kind == "command":
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+# ------------------------------------------------------------------
+#  Load generation
+# ------------------------------------------------------------------
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+class CompletionTracker(BaseUpdateProcessor):
+    # Wraps the application's own update processor (sequential for polling,
+    # per-chat for webhook mode) and resolves a future once an update fed
+    # through update_queue has been handled
+    def __init__(self, inner: BaseUpdateProcessor):
+        super().__init__(inner.max_concurrent_updates)
+        self.inner = inner
+        self.pending: dict[int, asyncio.Future] = {}
+
+    async def process_update(self, update, coroutine):
+        try:
+            await self.inner.process_update(update, coroutine)
+        except Exception as e:
+            future = self.pending.pop(update.update_id, None)
+            if future and not future.done():
+                future.set_exception(e)
+            raise
+        future = self.pending.pop(update.update_id, None)
+        if future and not future.done():
+            future.set_result(None)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+_update_ids = itertools.count(1)
+
+def dropped_taps(bot) -> int:
+    return bot.tap_dedup.inflight_dropped + bot.tap_dedup.debounced
+
+async def run_phase(bot, app, tracker: CompletionTracker, scenario: str, args, counters) -> dict:
+    Update = bot.Update
+    latencies: list[float] = []
+    errors = 0
+    total = int(args.rate * args.duration)
+    interval = 1 / args.rate
+    before = {name: sum(c.calls.values()) for name, c in counters.items()}
+    dropped_before = dropped_taps(bot)
+
+    async def one(i):
+        nonlocal errors
+        uid = 10_000 + random.randrange(args.users)
+        data = make_update(scenario, next(_update_ids), uid, referrer=10_000)
+        update = Update.de_json(data, app.bot)
+        done = tracker.pending[update.update_id] = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        # Through the queue, like the webhook server / updater would
+        await app.update_queue.put(update)
+        try:
+            await done
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    tasks = []
+    for i in range(total):
+        # Open loop: keep the arrival rate regardless of how slow handlers are
+        delay = started + i * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(i)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    result = {
+        "scenario": scenario,
+        "updates": total,
+        "errors": errors,
+        "throughput": total / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50) * 1000,
+        "p95": percentile(latencies, 95) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+        # Included in the percentiles; only non-zero with --debounce-window
+        "dropped": dropped_taps(bot) - dropped_before,
+    }
+    for name, service in counters.items():
+        result[f"{name}_calls"] = (sum(service.calls.values()) - before[name]) / total if total else 0.0
+    return result
+
+async def main_async(args):
+    workdir = tempfile.mkdtemp(prefix="kimem-bench-")
+    # The bot module provides the HTTP server used for the fakes as well
+    bot_api = FakeBotApi("123456:BENCH", args.bot_latency, args.jitter)
+    appwrite = FakeAppwrite(args.db_latency, args.jitter)
+
+    # The bot reads its endpoints at import time, so the ports are fixed up front
+    bot_port, db_port = args.bot_port, args.db_port
+    bot = load_bot(args, bot_port, db_port, workdir)
+
+    bot_server = bot.HttpServer("127.0.0.1", bot_port)
+    for method in ("getMe", "sendMessage", "sendPhoto", "copyMessage", "copyMessages",
+                   "getChatMember", "answerCallbackQuery", "deleteMessage",
+                   "editMessageCaption", "forwardMessage", "sendDocument"):
+        bot_server.route("POST", f"{bot_api.prefix}{method}", bot_api.handle)
+    db_server = bot.HttpServer("127.0.0.1", db_port)
+    db_server.routes = _CatchAll(appwrite.handle)
+    await bot_server.start()
+    await db_server.start()
+
+    app = bot.build_application(fed_externally=args.mode == "webhook")
+    # The builder offers no hook around the configured processor; swap it in
+    # before initialize() so the app's own concurrency rules still apply
+    tracker = CompletionTracker(app.update_processor)
+    app._update_processor = tracker
+
+    scenarios = args.scenarios or list(SCENARIOS)
+    results = []
+    try:
+        # post_init / post_shutdown included: warm-up, leaderboard, state flusher
+        async with bot.running_application(app):
+            # Seed the referrer used by start_ref
+            await bot.user_store.create_user("10000", {"user_id": "10000", "first_name": "Ref",
+                                                       "username": "", "referral_link": "", "coins": 0,
+                                                       "invite_count": 0})
+            for scenario in scenarios:
+                results.append(await run_phase(bot, app, tracker, scenario, args,
+                                               {"bot": bot_api, "db": appwrite}))
+    finally:
+        await bot.user_store.close()
+        await bot_server.stop()
+        await db_server.stop()
+
+    print()
+    print(f"{'scenario':<12}{'n':>7}{'err':>5}{'drop':>6}{'upd/s':>9}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'bot/upd':>9}{'db/upd':>8}")
+    for r in results:
+        print(f"{r['scenario']:<12}{r['updates']:>7}{r['errors']:>5}{r['dropped']:>6}{r['throughput']:>9.1f}"
+              f"{r['p50']:>9.1f}{r['p95']:>9.1f}{r['p99']:>9.1f}"
+              f"{r['bot_calls']:>9.2f}{r['db_calls']:>8.2f}")
+    print()
+    print("Bot API calls:", dict(bot_api.calls))
+    print("Appwrite calls:", dict(appwrite.calls))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.metrics:
+        with open(args.metrics, "w") as f:
+            f.write(bot.metrics.render())
+
+class _CatchAll(dict):
+    # Route table that sends every (method, path) to one handler
+    def __init__(self, handler):
+        super().__init__()
+        self.handler = handler
+
+    def get(self, key, default=None):
+        return self.handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Kimem UAT bot handlers")
+    parser.add_argument("--rate", type=float, default=100, help="updates per second per scenario")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per scenario")
+    parser.add_argument("--users", type=int, default=1000, help="distinct synthetic users")
+    parser.add_argument("--bot-latency", type=float, default=30, help="fake Bot API latency (ms)")
+    parser.add_argument("--db-latency", type=float, default=50, help="fake Appwrite latency (ms)")
+    parser.add_argument("--jitter", type=float, default=10, help="latency jitter (± ms)")
+    parser.add_argument("--storage", choices=("appwrite", "sqlite"), default="appwrite")
+    parser.add_argument("--mode", choices=("webhook", "polling"), default="webhook",
+                        help="update processing as in that BOT_MODE: per-chat concurrent or sequential")
+    parser.add_argument("--no-rate-limit", action="store_true", help="disable the send scheduler limits")
+    parser.add_argument("--debounce-window", type=float, default=0.0,
+                        help="duplicate tap window in seconds (default 0: every update reaches its handler)")
+    parser.add_argument("--bot-port", type=int, default=18081)
+    parser.add_argument("--db-port", type=int, default=18082)
+    parser.add_argument("--log-level", default="WARNING", help="log level for the bot and its clients")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--metrics", help="write the bot's Prometheus metrics to this file at the end")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"subset of: {', '.join(SCENARIOS)} (default: all)")
+    args = parser.parse_args()
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    asyncio.run(main_async(args))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,26 +1,51 @@
 # bot.py
 import os
 import json
+import heapq
+import hmac
+import random
+import re
+import argparse
+import asyncio
+import bisect
+import contextlib
 import datetime
 import logging
+import math
+import multiprocessing
+import sqlite3
+import signal
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
+from typing import NamedTuple
+import httpx
 from dotenv import load_dotenv
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    MessageEntity,
     ReplyKeyboardMarkup,
 )
 from telegram.ext import (
     ApplicationBuilder,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     ContextTypes,
     CommandHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     MessageHandler,
     filters,
 )
-from appwrite.client import Client
-from appwrite.services.databases import Databases
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
 from appwrite.query import Query
 
 # ------------------------------------------------------------------
@@ -33,84 +58,1327 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Malformed values are collected here and reported by validate_config()
+CONFIG_ERRORS: list[str] = []
+
+def _env_number(name: str, default, cast):
+    raw = os.getenv(name)
+    if raw is None or raw.strip() == "":
+        return default
+    try:
+        value = cast(raw)
+    except ValueError:
+        CONFIG_ERRORS.append(f"{name} must be a{'n integer' if cast is int else ' number'}, got {raw!r}")
+        return default
+    if value < 0:
+        CONFIG_ERRORS.append(f"{name} must not be negative, got {raw!r}")
+        return default
+    return value
+
+def env_int(name: str, default: int) -> int:
+    return _env_number(name, default, int)
+
+def env_float(name: str, default: float) -> float:
+    return _env_number(name, default, float)
+
 BOT_TOKEN          = os.getenv("BOT_TOKEN")
+ADMIN_IDS          = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().isdigit()}
 CHANNEL_USERNAME   = os.getenv("CHANNEL_USERNAME")
 DB_CHANNEL_USERNAME= os.getenv("DB_MAIN_CHANNEL_USERNAME")  # kept for forwarder
 
+# ------------ Storage ------------
+STORAGE_BACKEND    = os.getenv("STORAGE_BACKEND", "appwrite")   # appwrite | sqlite
+SQLITE_PATH        = os.getenv("SQLITE_PATH", "kimem.db")
+
 # ------------ Appwrite ------------
 APPWRITE_ENDPOINT  = os.getenv("APPWRITE_ENDPOINT", "https://cloud.appwrite.io/v1")
 APPWRITE_PROJECT   = os.getenv("APPWRITE_PROJECT_ID")
 APPWRITE_KEY       = os.getenv("APPWRITE_API_KEY")
 APPWRITE_DB        = os.getenv("APPWRITE_DATABASE_ID")
 APPWRITE_COLL      = os.getenv("APPWRITE_COLLECTION_ID")
+APPWRITE_INVITES   = os.getenv("APPWRITE_INVITES_COLLECTION_ID")   # one document per invite
+
+APPWRITE_MAX_CONNECTIONS = env_int("APPWRITE_MAX_CONNECTIONS", 20)
+APPWRITE_CONCURRENCY     = env_int("APPWRITE_CONCURRENCY", 10)
+APPWRITE_TIMEOUT         = env_float("APPWRITE_TIMEOUT", 10)
+APPWRITE_RETRIES         = env_int("APPWRITE_RETRIES", 3)
+
+# ------------ Per-user state (menu position) ------------
+STATE_PATH               = os.getenv("STATE_PATH", "state.db")
+STATE_CACHE_SIZE         = env_int("STATE_CACHE_SIZE", 20000)
+STATE_FLUSH_INTERVAL     = env_float("STATE_FLUSH_INTERVAL", 5)
+
+# ------------ Caches ------------
+USER_CACHE_SIZE          = env_int("USER_CACHE_SIZE", 50000)
+USER_CACHE_TTL           = env_float("USER_CACHE_TTL", 900)
+CACHE_STATS_INTERVAL     = env_float("CACHE_STATS_INTERVAL", 600)
+MEDIA_CACHE_PATH         = os.getenv("MEDIA_CACHE_PATH", "media_cache.json")
+CONTENT_INDEX_PATH       = os.getenv("CONTENT_INDEX_PATH", "content_index.json")
+CONTENT_INDEX_TTL        = env_float("CONTENT_INDEX_TTL", 24 * 3600)
+CONTENT_MIRROR_CHAT_ID   = os.getenv("CONTENT_MIRROR_CHAT_ID")      # scratch chat used to read sources
+MEMBER_TTL_POSITIVE      = env_float("MEMBER_TTL_POSITIVE", 3600)
+MEMBER_TTL_NEGATIVE      = env_float("MEMBER_TTL_NEGATIVE", 5)
+WARMUP_TIMEOUT           = env_float("WARMUP_TIMEOUT", 20)          # max seconds before taking updates
+
+# ------------ Serving ------------
+BOT_MODE                 = os.getenv("BOT_MODE", "polling")        # polling | webhook
+BOT_API_URL              = os.getenv("BOT_API_URL")                 # e.g. a local Bot API server
+WEBHOOK_URL              = os.getenv("WEBHOOK_URL")                 # unset: don't call setWebhook
+WEBHOOK_LISTEN           = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT             = env_int("PORT", 8443)
+WEBHOOK_PATH             = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET           = os.getenv("WEBHOOK_SECRET")
+MAX_CONCURRENT_UPDATES   = env_int("MAX_CONCURRENT_UPDATES", 64)
+DEBOUNCE_WINDOW          = env_float("DEBOUNCE_WINDOW", 1.5)  # seconds, 0: off
+WORKERS                  = env_int("WORKERS", 1)             # > 1: receiver + N worker processes
+
+# ------------ Metrics ------------
+METRICS_LISTEN           = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT             = env_int("METRICS_PORT", 0)       # 0: no metrics endpoint
+PROFILE_INTERVAL         = env_float("PROFILE_INTERVAL", 0)  # seconds between samples, 0: off
+
+# ------------ Outbound rate limits ------------
+SEND_GLOBAL_RATE         = env_float("SEND_GLOBAL_RATE", 30)   # requests / second
+SEND_CHAT_RATE           = env_float("SEND_CHAT_RATE", 1)      # per private chat
+SEND_CHAT_BURST          = env_float("SEND_CHAT_BURST", 5)
+SEND_GROUP_RATE          = env_float("SEND_GROUP_RATE", 20 / 60)
+SEND_MAX_RETRIES         = env_int("SEND_MAX_RETRIES", 3)
+
+# ------------ Broadcast ------------
+BROADCAST_WORKERS         = env_int("BROADCAST_WORKERS", 16)
+BROADCAST_PAGE_SIZE       = env_int("BROADCAST_PAGE_SIZE", 100)
+BROADCAST_CHECKPOINT_PATH = os.getenv("BROADCAST_CHECKPOINT_PATH", "broadcast.json")
+BROADCAST_REPORT_INTERVAL = env_float("BROADCAST_REPORT_INTERVAL", 15)
+
+# ------------ Legacy schema migration ------------
+MIGRATE_CONCURRENCY      = env_int("MIGRATE_CONCURRENCY", 8)
+MIGRATE_CHECKPOINT_PATH  = os.getenv("MIGRATE_CHECKPOINT_PATH", "migrate.json")
+RECONCILE_INTERVAL       = env_float("RECONCILE_INTERVAL", 900)  # stuck-credit repair, 0: off
+
+COVER_IMAGE    = "img/cover.png"
+REFERRAL_IMAGE = "img/referral.png"
+
+# ------------------------------------------------------------------
+#  Background tasks
+# ------------------------------------------------------------------
+_background_tasks: set = set()
+
+def spawn(coro) -> asyncio.Task:
+    # Fire-and-forget with a strong reference so the task isn't collected
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# ------------------------------------------------------------------
+#  Cache coherence between worker processes
+# ------------------------------------------------------------------
+class CacheBus:
+    # With WORKERS > 1 every worker process keeps its own caches. A write
+    # another worker may have cached is published as a (kind, args) event;
+    # the receiver relays it to all other workers, which apply it through
+    # the handler registered for that kind. In a single process, publishing
+    # is a no-op.
+    def __init__(self):
+        self.worker_index = 0
+        self.workers = 1
+        self._outbox = None
+        self._handlers: dict = {}
+        self.published = 0
+        self.applied = 0
+
+    @property
+    def clustered(self) -> bool:
+        return self._outbox is not None
+
+    @property
+    def leader(self) -> bool:
+        # Worker 0 does the once-per-deployment jobs (content warm-up)
+        return self.worker_index == 0
+
+    def connect(self, worker_index: int, workers: int, outbox):
+        self.worker_index = worker_index
+        self.workers = workers
+        self._outbox = outbox
+
+    def on(self, kind: str, handler):
+        self._handlers[kind] = handler
+
+    def publish(self, kind: str, *args):
+        if self._outbox is None:
+            return
+        self._outbox.put((self.worker_index, (kind, args)))
+        self.published += 1
+
+    def apply(self, event: tuple):
+        kind, args = event
+        handler = self._handlers.get(kind)
+        if handler is None:
+            logger.warning("No handler for cache event %r", kind)
+            return
+        handler(*args)
+        self.applied += 1
+
+    def stats(self) -> dict:
+        return {"published": self.published, "applied": self.applied}
+
+cache_bus = CacheBus()
+
+# ------------------------------------------------------------------
+#  Metrics
+# ------------------------------------------------------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    # In-process counters, histograms and gauges, rendered in the Prometheus
+    # text format. Gauges are callbacks read at scrape time; a callback may
+    # return a number or a {label value: number} dict.
+    def __init__(self):
+        self._meta: dict[str, tuple[str, str]] = {}
+        self._counters: dict[tuple, float] = {}
+        self._histograms: dict[tuple, Histogram] = {}
+        self._gauges: dict[str, tuple] = {}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        hist = self._histograms.get(key)
+        if hist is None:
+            hist = self._histograms[key] = Histogram()
+        hist.observe(value)
+
+    def gauge(self, name: str, help_text: str, fn, label: str | None = None):
+        self.describe(name, "gauge", help_text)
+        self._gauges[name] = (fn, label)
+
+    @staticmethod
+    def _labels(pairs) -> str:
+        if not pairs:
+            return ""
+        def escape(value) -> str:
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+    @staticmethod
+    def _number(value) -> str:
+        # Full precision: "%g" turns 1234567 into 1.23457e+06, which makes
+        # large counters plateau and rate() step
+        if isinstance(value, float):
+            if math.isinf(value):
+                return "+Inf" if value > 0 else "-Inf"
+            return "NaN" if math.isnan(value) else repr(value)
+        return str(int(value))
+
+    def render(self) -> str:
+        lines = []
+        by_name: dict[str, list] = {}
+        for (name, labels), value in self._counters.items():
+            by_name.setdefault(name, []).append(f"{name}{self._labels(labels)} {self._number(value)}")
+        for (name, labels), hist in self._histograms.items():
+            rows = by_name.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip((*hist.buckets, "+Inf"), hist.counts):
+                cumulative += count
+                rows.append(f"{name}_bucket{self._labels((*labels, ('le', bound)))} {cumulative}")
+            rows.append(f"{name}_sum{self._labels(labels)} {hist.sum:.6f}")
+            rows.append(f"{name}_count{self._labels(labels)} {hist.count}")
+        for name, (fn, label) in self._gauges.items():
+            try:
+                value = fn()
+            except Exception as e:
+                logger.warning("Gauge %s failed: %s", name, e)
+                continue
+            if isinstance(value, dict):
+                by_name[name] = [
+                    f"{name}{self._labels(((label, k),))} {self._number(v)}"
+                    for k, v in value.items() if isinstance(v, (int, float))
+                ]
+            else:
+                by_name[name] = [f"{name} {self._number(value)}"]
+        for name, rows in sorted(by_name.items()):
+            kind, help_text = self._meta.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(rows)
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("kimem_handler_duration_seconds", "histogram", "Handler latency by handler / text route")
+metrics.describe("kimem_handler_errors_total", "counter", "Handlers that raised, by handler")
+metrics.describe("kimem_appwrite_request_duration_seconds", "histogram", "Appwrite call latency incl. retries, by operation")
+metrics.describe("kimem_appwrite_errors_total", "counter", "Failed Appwrite calls by operation and status")
+metrics.describe("kimem_appwrite_retries_total", "counter", "Retried Appwrite attempts by operation")
+metrics.describe("kimem_bot_api_duration_seconds", "histogram", "Bot API call latency (excluding rate-limit wait) by method")
+metrics.describe("kimem_bot_api_errors_total", "counter", "Failed Bot API calls by method")
+metrics.describe("kimem_bot_api_retry_after_total", "counter", "RetryAfter (flood control) responses by method")
+metrics.describe("kimem_send_wait_seconds", "histogram", "Time spent waiting for the send scheduler by priority")
+
+def instrument_handler(name: str, callback):
+    async def timed(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc("kimem_handler_errors_total", handler=name)
+            raise
+        finally:
+            metrics.observe("kimem_handler_duration_seconds", time.perf_counter() - started, handler=name)
+    timed.__name__ = getattr(callback, "__name__", name)
+    return timed
+
+class SamplingProfiler:
+    # Samples the event-loop thread's stack from a side thread and counts
+    # collapsed stacks ("outer;inner;leaf N"), ready for flamegraph.pl or
+    # speedscope. Only CPU time spent in Python shows up; awaiting is idle.
+    MAX_STACKS = 20_000
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples: dict[str, int] = {}
+        self._target = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        logger.info("Sampling profiler running every %.3fs", self.interval)
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if not stack:
+                continue
+            key = ";".join(reversed(stack))
+            if key in self.samples or len(self.samples) < self.MAX_STACKS:
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def collapsed(self, reset: bool = False) -> str:
+        samples = self.samples
+        if reset:
+            self.samples = {}
+        rows = sorted(samples.items(), key=lambda kv: kv[1], reverse=True)
+        return "".join(f"{stack} {count}\n" for stack, count in rows)
+
+profiler = SamplingProfiler(PROFILE_INTERVAL) if PROFILE_INTERVAL > 0 else None
+
+# ------------------------------------------------------------------
+#  Storage backends
+# ------------------------------------------------------------------
+class UserExists(Exception):
+    pass
+
+class UserStore(ABC):
+    # User documents are dicts keyed like the Appwrite ones ("$id", "user_id",
+    # "coins", "invite_count", ...); invitee records carry "$id", "user_id",
+    # "name" and "date".
+    @abstractmethod
+    async def get_user(self, uid: str) -> dict | None: ...
+
+    @abstractmethod
+    async def create_user(self, uid: str, data: dict) -> dict:
+        # Raises UserExists if the document is already there
+        ...
+
+    @abstractmethod
+    async def update_user(self, uid: str, data: dict) -> dict: ...
+
+    @abstractmethod
+    async def credit_referrer(self, referrer_uid: str, invitee: dict, reward: int) -> dict | None:
+        # Records the invite and bumps the counters once per invitee; returns
+        # the referrer's new {"coins", "invite_count"}, None if already credited
+        ...
+
+    @abstractmethod
+    async def list_invites(self, referrer_uid: str, *, after: str | None = None,
+                           before: str | None = None, limit: int = 10) -> list[dict]: ...
+
+    @abstractmethod
+    async def list_users(self, *, after: str | None = None, limit: int = 100) -> list[dict]:
+        # One page of user documents ordered by id, starting after the cursor
+        ...
+
+    @abstractmethod
+    async def count_users(self) -> int: ...
+
+    async def warm(self, connections: int):
+        # Open connections / files ahead of the first request
+        await self.count_users()
+
+    async def reconcile_credits(self, reward: int, grace: float = 600) -> dict[str, dict]:
+        # Finishes credits that stopped between recording the invite and
+        # bumping the counters; returns {referrer uid: new counters}.
+        # Backends that credit in one transaction have nothing to repair.
+        return {}
+
+    async def record_invite(self, referrer_uid: str, invitee: dict):
+        # Records the invite without crediting it, for referrers still on the
+        # legacy schema; only stores that have legacy documents need this
+        raise NotImplementedError
+
+    async def iter_user_pages(self, *, after: str | None = None, page_size: int = 100):
+        # Streams the collection page by page, prefetching the next page while
+        # the caller works on the current one; never holds more than two.
+        page = await self.list_users(after=after, limit=page_size)
+        while page:
+            if len(page) < page_size:
+                yield page
+                return
+            upcoming = asyncio.ensure_future(self.list_users(after=page[-1]["$id"], limit=page_size))
+            try:
+                yield page
+            except BaseException:
+                upcoming.cancel()
+                raise
+            page = await upcoming
+
+    async def upgrade_legacy(self, uid: str) -> dict | None:
+        return await self.get_user(uid)
+
+    async def close(self):
+        pass
+
+class AppwriteError(Exception):
+    def __init__(self, status: int, message: str, after_retry: bool = False):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        # Set on a 409 answering a retry of a request that may already have
+        # been applied: the conflicting document is most likely our own
+        self.after_retry = after_retry
+
+class AppwriteUserStore(UserStore):
+    # The Appwrite SDK is blocking (requests); talk to the REST API directly
+    # over one keep-alive httpx pool so lookups never stall the event loop.
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    # Failures that guarantee the request never reached Appwrite
+    NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+    def __init__(self, endpoint: str, project: str, key: str, database_id: str, collection_id: str,
+                 invites_collection_id: str | None = None, *, max_connections: int = 20, concurrency: int = 10,
+                 timeout: float = 10.0, retries: int = 3, backoff: float = 0.3):
+        self.endpoint = endpoint.rstrip("/")
+        self.project = project
+        self.key = key
+        self.database_id = database_id
+        self.collection_id = collection_id
+        self.invites_collection_id = invites_collection_id
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._sem = asyncio.Semaphore(concurrency)
+        self._upgrading: dict[str, asyncio.Future] = {}
+        self._client: httpx.AsyncClient | None = None
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.endpoint,
+                headers={
+                    "X-Appwrite-Project": self.project or "",
+                    "X-Appwrite-Key": self.key or "",
+                    "Content-Type": "application/json",
+                },
+                timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 5.0)),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=60,
+                ),
+            )
+        return self._client
+
+    def _documents_path(self, document_id: str | None = None, collection_id: str | None = None) -> str:
+        path = f"/databases/{self.database_id}/collections/{collection_id or self.collection_id}/documents"
+        return f"{path}/{document_id}" if document_id else path
+
+    def _op(self, action: str, collection_id: str | None) -> str:
+        # Metrics label: "users.get", "invites.create", ...
+        users = collection_id in (None, self.collection_id)
+        return f"{'users' if users else 'invites'}.{action}"
+
+    async def _request(self, op: str, method: str, path: str, *, params=None, body: dict | None = None,
+                       idempotent: bool = True) -> dict:
+        started = time.perf_counter()
+        try:
+            return await self._attempt(op, method, path, params=params, body=body, idempotent=idempotent)
+        except AppwriteError as e:
+            metrics.inc("kimem_appwrite_errors_total", op=op, status=str(e.status))
+            raise
+        except httpx.TransportError:
+            metrics.inc("kimem_appwrite_errors_total", op=op, status="transport")
+            raise
+        finally:
+            metrics.observe("kimem_appwrite_request_duration_seconds", time.perf_counter() - started, op=op)
+
+    async def _attempt(self, op: str, method: str, path: str, *, params=None, body: dict | None = None,
+                       idempotent: bool = True) -> dict:
+        # A request that isn't idempotent is only retried when it can't have
+        # been applied: it never left (NOT_SENT) or was rate limited (429).
+        uncertain = False  # an earlier attempt may have been applied
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._sem:
+                    resp = await self._http().request(method, path, params=params, json=body)
+            except httpx.TransportError as e:
+                error = e
+                if not isinstance(e, self.NOT_SENT):
+                    if not idempotent:
+                        raise
+                    uncertain = True
+            else:
+                if resp.status_code < 400:
+                    return resp.json()
+                try:
+                    message = resp.json().get("message", resp.text)
+                except ValueError:
+                    message = resp.text
+                error = AppwriteError(resp.status_code, message, after_retry=uncertain and resp.status_code == 409)
+                if resp.status_code not in self.RETRY_STATUSES or not (idempotent or resp.status_code == 429):
+                    raise error
+                uncertain = uncertain or resp.status_code != 429
+            if attempt == self.retries:
+                raise error
+            metrics.inc("kimem_appwrite_retries_total", op=op)
+            delay = self.backoff * 2 ** attempt
+            await asyncio.sleep(delay + random.uniform(0, delay))
+
+    async def list_documents(self, queries: list[str], collection_id: str | None = None) -> dict:
+        params = [("queries[]", q) for q in queries]
+        return await self._request(
+            self._op("list", collection_id), "GET", self._documents_path(None, collection_id), params=params
+        )
+
+    async def get_document(self, document_id: str, collection_id: str | None = None) -> dict:
+        return await self._request(
+            self._op("get", collection_id), "GET", self._documents_path(document_id, collection_id)
+        )
+
+    async def create_document(self, document_id: str, data: dict, collection_id: str | None = None) -> dict:
+        return await self._request(
+            self._op("create", collection_id), "POST", self._documents_path(None, collection_id),
+            body={"documentId": document_id, "data": data},
+        )
+
+    async def update_document(self, document_id: str, data: dict, collection_id: str | None = None) -> dict:
+        return await self._request(
+            self._op("update", collection_id), "PATCH", self._documents_path(document_id, collection_id),
+            body={"data": data},
+        )
+
+    async def increment(self, document_id: str, attribute: str, value: int = 1) -> dict:
+        # Server-side atomic increment (Appwrite >= 1.7). Resending one that
+        # timed out could apply it twice, so it's never retried blindly.
+        path = f"{self._documents_path(document_id)}/{attribute}/increment"
+        return await self._request(
+            self._op("increment", None), "PATCH", path, body={"value": value}, idempotent=False
+        )
+
+    async def create_invite(self, invitee_id: str, data: dict) -> dict:
+        return await self.create_document(invitee_id, data, self.invites_collection_id)
+
+    async def mark_invite_credited(self, invitee_id: str) -> dict:
+        return await self.update_document(invitee_id, {"credited": True}, self.invites_collection_id)
+
+    async def get_user(self, uid: str) -> dict | None:
+        try:
+            return await self.get_document(uid)
+        except AppwriteError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    async def create_user(self, uid: str, data: dict) -> dict:
+        try:
+            return await self.create_document(uid, data)
+        except AppwriteError as e:
+            if e.status != 409:
+                raise
+            if e.after_retry:
+                # Our first attempt landed before the retry: it is still a
+                # new user (intro, referral credit), not a returning one
+                doc = await self.get_user(uid)
+                if doc is not None:
+                    return doc
+            raise UserExists(uid) from e
+
+    async def update_user(self, uid: str, data: dict) -> dict:
+        return await self.update_document(uid, data)
+
+    async def credit_referrer(self, referrer_uid: str, invitee: dict, reward: int) -> dict | None:
+        # The invite record (id = invitee uid) makes crediting idempotent; the
+        # counters are bumped server-side so concurrent signups can't lose credit.
+        # If the increments fail or the process dies before they land, the
+        # invite stays credited=False and reconcile_credits() repairs it.
+        invitee_uid = invitee["user_id"]
+        try:
+            await self.create_invite(invitee_uid, {
+                "referrer_id": referrer_uid,
+                **invitee,
+                "credited":    False,
+            })
+        except AppwriteError as e:
+            if e.status != 409:
+                raise
+            if not e.after_retry:
+                # Recorded by another credit, finished or still in flight
+                return None
+            # Our first attempt landed before the retry: finish it
+        counters = await self._add_credit(referrer_uid, reward)
+        await self.mark_invite_credited(invitee_uid)
+        return counters
+
+    async def record_invite(self, referrer_uid: str, invitee: dict):
+        # The referrer is still legacy and only `migrate` may touch its
+        # counters: the invite waits uncredited until reconcile_credits()
+        # finds it on a migrated referrer
+        try:
+            await self.create_invite(invitee["user_id"], {
+                "referrer_id": referrer_uid,
+                **invitee,
+                "credited":    False,
+            })
+        except AppwriteError as e:
+            if e.status != 409:
+                raise
+
+    async def _add_credit(self, referrer_uid: str, reward: int) -> dict:
+        coins_doc, count_doc = await asyncio.gather(
+            self.increment(referrer_uid, "coins", reward),
+            self.increment(referrer_uid, "invite_count", 1),
+        )
+        return {"coins": coins_doc["coins"], "invite_count": count_doc["invite_count"]}
+
+    async def reconcile_credits(self, reward: int, grace: float = 600) -> dict[str, dict]:
+        # Invites still uncredited after `grace` seconds will never be
+        # finished by the bot that recorded them: add exactly their credit
+        # (increments, so concurrent credits to the same referrer stay
+        # intact), then mark them. Invites of referrers that are still legacy
+        # are left for after `migrate` has upgraded them.
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=grace)
+        repaired: dict[str, dict] = {}
+        legacy: dict[str, bool] = {}
+        cursor = None
+        while True:
+            queries = [Query.equal("credited", False), Query.created_before(cutoff.isoformat()),
+                       Query.order_asc("$id"), Query.limit(100)]
+            if cursor:
+                queries.append(Query.cursor_after(cursor))
+            stuck = (await self.list_documents(queries, self.invites_collection_id))["documents"]
+            if not stuck:
+                return repaired
+            cursor = stuck[-1]["$id"]
+            for doc in stuck:
+                try:
+                    if doc["referrer_id"] not in legacy:
+                        referrer = await self.get_user(doc["referrer_id"])
+                        legacy[doc["referrer_id"]] = referrer is None or is_legacy_doc(referrer)
+                    if legacy[doc["referrer_id"]]:
+                        continue
+                    repaired[doc["referrer_id"]] = await self._add_credit(doc["referrer_id"], reward)
+                    await self.mark_invite_credited(doc["$id"])
+                except (AppwriteError, httpx.TransportError) as e:
+                    logger.error("Could not reconcile invite %s: %s", doc["$id"], e)
+                else:
+                    logger.info("Reconciled invite %s for referrer %s", doc["$id"], doc["referrer_id"])
+
+    async def list_invites(self, referrer_uid: str, *, after: str | None = None,
+                           before: str | None = None, limit: int = 10) -> list[dict]:
+        # Oldest invite first, as the invited list used to be; the invitee id
+        # only breaks ties and serves as the cursor
+        queries = [Query.equal("referrer_id", referrer_uid), Query.order_asc("date"), Query.order_asc("$id")]
+        if before:
+            queries.append(Query.cursor_before(before))
+        elif after:
+            queries.append(Query.cursor_after(after))
+        queries.append(Query.limit(limit))
+        res = await self.list_documents(queries, self.invites_collection_id)
+        return res["documents"]
+
+    async def list_users(self, *, after: str | None = None, limit: int = 100) -> list[dict]:
+        queries = [Query.order_asc("$id"), Query.limit(limit)]
+        if after:
+            queries.append(Query.cursor_after(after))
+        res = await self.list_documents(queries)
+        return res["documents"]
+
+    async def count_users(self) -> int:
+        res = await self.list_documents([Query.limit(1)])
+        return res["total"]
+
+    async def warm(self, connections: int):
+        # Concurrent cheap reads open (and TLS-handshake) that many pooled
+        # connections before the first user needs one
+        connections = max(1, min(connections, self.max_connections))
+        await asyncio.gather(*(self.list_documents([Query.limit(1)]) for _ in range(connections)))
+
+    async def upgrade_legacy(self, uid: str) -> dict | None:
+        # Single-flight per user within this process; different users
+        # upgrade in parallel
+        pending = self._upgrading.get(uid)
+        if pending is None:
+            pending = self._upgrading[uid] = asyncio.ensure_future(self._upgrade(uid))
+            pending.add_done_callback(lambda _: self._upgrading.pop(uid, None))
+        return await asyncio.shield(pending)
+
+    async def _upgrade(self, uid: str) -> dict | None:
+        # Move one legacy document to counters + invite records. Only
+        # `migrate` upgrades (one run at a time) and nothing credits a legacy
+        # document, so the counters are set straight from it: the balance is
+        # kept as it is, manual adjustments included. Idempotent: invite ids
+        # are the invitee uid and the counters are only written while
+        # invite_count is still null.
+        doc = await self.get_user(uid)
+        if doc is None or not is_legacy_doc(doc):
+            return doc
+        invited = json.loads(doc.get("invited") or "[]")
+
+        async def record(inv: dict):
+            try:
+                await self.create_invite(str(inv["user_id"]), {
+                    "referrer_id": uid,
+                    "user_id":     str(inv["user_id"]),
+                    "name":        inv.get("name", ""),
+                    "date":        inv.get("date", ""),
+                    "credited":    True,
+                })
+            except AppwriteError as e:
+                if e.status != 409:
+                    raise
+
+        await asyncio.gather(*(record(inv) for inv in invited))
+        # Re-read right before the write: if an earlier run got there first,
+        # reconcile may already have added credits on top of its counters
+        doc = await self.get_user(uid)
+        if doc is None or not is_legacy_doc(doc):
+            return doc
+        return await self.update_user(uid, {"coins": user_coins(doc), "invite_count": len(invited)})
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+class SQLiteUserStore(UserStore):
+    # Embedded single-file backend for one-box deployments and load tests.
+    # Every statement runs on one dedicated thread, which also serialises
+    # writes, so multi-statement updates are atomic without extra locking.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id      TEXT PRIMARY KEY,
+            data         TEXT NOT NULL,
+            coins        INTEGER NOT NULL DEFAULT 0,
+            invite_count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS invites (
+            invitee_id  TEXT PRIMARY KEY,
+            referrer_id TEXT NOT NULL,
+            name        TEXT NOT NULL,
+            date        TEXT NOT NULL
+        );
+        DROP INDEX IF EXISTS invites_by_referrer;
+        CREATE INDEX IF NOT EXISTS invites_by_referrer_date ON invites (referrer_id, date, invitee_id);
+    """
+    COUNTERS = ("coins", "invite_count")
+    LEGACY_FIELDS = ("kimem_coins", "invited")
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn: sqlite3.Connection | None = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    @staticmethod
+    def _row_to_doc(row) -> dict:
+        user_id, data, coins, invite_count = row
+        return {**json.loads(data), "$id": user_id, "user_id": user_id,
+                "coins": coins, "invite_count": invite_count}
+
+    def _get(self, uid: str) -> dict | None:
+        row = self._db().execute(
+            "SELECT user_id, data, coins, invite_count FROM users WHERE user_id = ?", (uid,)
+        ).fetchone()
+        return self._row_to_doc(row) if row else None
+
+    def _create(self, uid: str, data: dict) -> dict:
+        fields = {k: v for k, v in data.items() if k not in self.COUNTERS + self.LEGACY_FIELDS}
+        try:
+            self._db().execute(
+                "INSERT INTO users (user_id, data, coins, invite_count) VALUES (?, ?, ?, ?)",
+                (uid, json.dumps(fields), data.get("coins", 0), data.get("invite_count", 0)),
+            )
+        except sqlite3.IntegrityError as e:
+            raise UserExists(uid) from e
+        return self._get(uid)
+
+    def _update(self, uid: str, data: dict) -> dict:
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT data FROM users WHERE user_id = ?", (uid,)).fetchone()
+            if row is None:
+                raise KeyError(uid)
+            fields = json.loads(row[0])
+            fields.update({k: v for k, v in data.items() if k not in self.COUNTERS})
+            db.execute("UPDATE users SET data = ? WHERE user_id = ?", (json.dumps(fields), uid))
+            for counter in self.COUNTERS:
+                if counter in data:
+                    db.execute(f"UPDATE users SET {counter} = ? WHERE user_id = ?", (int(data[counter]), uid))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return self._get(uid)
+
+    def _credit(self, referrer_uid: str, invitee: dict, reward: int) -> dict | None:
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            inserted = db.execute(
+                "INSERT OR IGNORE INTO invites (invitee_id, referrer_id, name, date) VALUES (?, ?, ?, ?)",
+                (invitee["user_id"], referrer_uid, invitee["name"], invitee["date"]),
+            ).rowcount
+            counters = None
+            if inserted:
+                db.execute(
+                    "UPDATE users SET coins = coins + ?, invite_count = invite_count + 1 WHERE user_id = ?",
+                    (reward, referrer_uid),
+                )
+                row = db.execute(
+                    "SELECT coins, invite_count FROM users WHERE user_id = ?", (referrer_uid,)
+                ).fetchone()
+                counters = {"coins": row[0], "invite_count": row[1]} if row else None
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return counters
+
+    def _list_invites(self, referrer_uid: str, after: str | None, before: str | None, limit: int) -> list[dict]:
+        # Ordered by (date, invitee_id) like the Appwrite backend; the cursor
+        # is an invitee id whose position is looked up in the same query
+        position = "(SELECT date, invitee_id FROM invites WHERE invitee_id = ?)"
+        if before:
+            rows = self._db().execute(
+                f"SELECT invitee_id, name, date FROM invites WHERE referrer_id = ? AND (date, invitee_id) < {position}"
+                " ORDER BY date DESC, invitee_id DESC LIMIT ?", (referrer_uid, before, limit)
+            ).fetchall()[::-1]
+        elif after:
+            rows = self._db().execute(
+                f"SELECT invitee_id, name, date FROM invites WHERE referrer_id = ? AND (date, invitee_id) > {position}"
+                " ORDER BY date, invitee_id LIMIT ?", (referrer_uid, after, limit)
+            ).fetchall()
+        else:
+            rows = self._db().execute(
+                "SELECT invitee_id, name, date FROM invites WHERE referrer_id = ?"
+                " ORDER BY date, invitee_id LIMIT ?", (referrer_uid, limit)
+            ).fetchall()
+        return [{"$id": i, "user_id": i, "name": n, "date": d} for i, n, d in rows]
+
+    def _list_users(self, after: str | None, limit: int) -> list[dict]:
+        rows = self._db().execute(
+            "SELECT user_id, data, coins, invite_count FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+            (after or "", limit),
+        ).fetchall()
+        return [self._row_to_doc(row) for row in rows]
+
+    def _count_users(self) -> int:
+        return self._db().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    async def get_user(self, uid: str) -> dict | None:
+        return await self._run(self._get, uid)
+
+    async def create_user(self, uid: str, data: dict) -> dict:
+        return await self._run(self._create, uid, data)
+
+    async def update_user(self, uid: str, data: dict) -> dict:
+        return await self._run(self._update, uid, data)
+
+    async def credit_referrer(self, referrer_uid: str, invitee: dict, reward: int) -> dict | None:
+        return await self._run(self._credit, referrer_uid, invitee, reward)
+
+    async def list_invites(self, referrer_uid: str, *, after: str | None = None,
+                           before: str | None = None, limit: int = 10) -> list[dict]:
+        return await self._run(self._list_invites, referrer_uid, after, before, limit)
+
+    async def list_users(self, *, after: str | None = None, limit: int = 100) -> list[dict]:
+        return await self._run(self._list_users, after, limit)
+
+    async def count_users(self) -> int:
+        return await self._run(self._count_users)
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+
+def build_user_store() -> UserStore:
+    if STORAGE_BACKEND == "sqlite":
+        logger.info("Using SQLite storage at %s", SQLITE_PATH)
+        return SQLiteUserStore(SQLITE_PATH)
+    return AppwriteUserStore(
+        APPWRITE_ENDPOINT, APPWRITE_PROJECT, APPWRITE_KEY, APPWRITE_DB, APPWRITE_COLL, APPWRITE_INVITES,
+        max_connections=APPWRITE_MAX_CONNECTIONS,
+        concurrency=APPWRITE_CONCURRENCY,
+        timeout=APPWRITE_TIMEOUT,
+        retries=APPWRITE_RETRIES,
+    )
+
+user_store = build_user_store()
+
+# ------------------------------------------------------------------
+#  User document cache
+# ------------------------------------------------------------------
+class TTLCache:
+    # LRU-ordered dict with per-entry expiry; maxsize bounds memory.
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl: float | None = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def merge(self, key, fields: dict):
+        # Write-through for partial updates; only touches live entries
+        entry = self._data.get(key)
+        if entry is not None and entry[0] >= time.monotonic():
+            self.set(key, {**entry[1], **fields})
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def _apply_user_event(uid: int, fields: dict | None):
+    # fields: merge a partial update; None: the document changed, drop it
+    if fields:
+        user_cache.merge(uid, fields)
+    else:
+        user_cache.pop(uid)
+
+cache_bus.on("user", _apply_user_event)
+
+# ------------------------------------------------------------------
+#  Per-user state store
+# ------------------------------------------------------------------
+class StateStore:
+    # Small per-user state dicts (the menu stack) that survive restarts.
+    # Nothing is read at startup: a user's row is loaded on first access into
+    # an LRU. Writers call changed(uid); a timer writes only the changed rows,
+    # all in one transaction. Dirty entries pushed out of the LRU wait in
+    # _evicted until that flush so no change is lost.
+    SCHEMA = "CREATE TABLE IF NOT EXISTS user_state (user_id INTEGER PRIMARY KEY, state TEXT NOT NULL)"
+
+    def __init__(self, path: str, max_entries: int, flush_interval: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self._data: OrderedDict[int, dict] = OrderedDict()
+        self._dirty: set[int] = set()
+        self._evicted: dict[int, dict] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+        self._conn: sqlite3.Connection | None = None
+        self._flusher: asyncio.Task | None = None
+        self.loads = 0
+        self.flushes = 0
+        self.rows_written = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(self.SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _load(self, uid: int) -> dict:
+        row = self._db().execute("SELECT state FROM user_state WHERE user_id = ?", (uid,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def _write(self, rows: list[tuple[int, str | None]]):
+        db = self._db()
+        db.execute("BEGIN")
+        try:
+            db.executemany(
+                "INSERT OR REPLACE INTO user_state (user_id, state) VALUES (?, ?)",
+                [row for row in rows if row[1] is not None],
+            )
+            db.executemany("DELETE FROM user_state WHERE user_id = ?", [(uid,) for uid, state in rows if state is None])
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    async def get(self, uid: int) -> dict:
+        state = self._data.get(uid)
+        if state is not None:
+            self._data.move_to_end(uid)
+            return state
+        state = self._evicted.pop(uid, None)
+        if state is None:
+            loaded = await self._run(self._load, uid)
+            self.loads += 1
+            # Another update of this user may have loaded it meanwhile
+            state = self._data.get(uid)
+            if state is None:
+                state = loaded
+        self._data[uid] = state
+        self._data.move_to_end(uid)
+        while len(self._data) > self.max_entries:
+            old_uid, old_state = self._data.popitem(last=False)
+            if old_uid in self._dirty:
+                self._evicted[old_uid] = old_state
+        return state
+
+    def changed(self, uid: int):
+        self._dirty.add(uid)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        rows = []
+        for uid in dirty:
+            # Serialise here, not on the writer thread, while nothing can mutate the state;
+            # an empty state (e.g. back at home) costs no row at all
+            state = self._data.get(uid) or self._evicted.get(uid) or {}
+            if any(state.values()):
+                rows.append((uid, json.dumps(state, separators=(",", ":"))))
+            else:
+                rows.append((uid, None))
+        try:
+            await self._run(self._write, rows)
+        except Exception as e:
+            logger.error("State flush failed (%d rows): %s", len(rows), e)
+            self._dirty |= dirty
+            return
+        for uid in dirty:
+            self._evicted.pop(uid, None)
+        self.flushes += 1
+        self.rows_written += len(rows)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {"cached": len(self._data), "dirty": len(self._dirty), "loads": self.loads,
+                "flushes": self.flushes, "rows_written": self.rows_written}
+
+user_state = StateStore(STATE_PATH, STATE_CACHE_SIZE, STATE_FLUSH_INTERVAL)
+
+# ------------------------------------------------------------------
+#  Referral leaderboard
+# ------------------------------------------------------------------
+class Leaderboard:
+    # Referrers ranked by invite count, kept as one sorted list of
+    # (-invites, uid) keys: rank lookups are a bisect, the top N is a slice
+    # and a credit moves one key. Users with no invites aren't stored.
+    # Built once from storage at startup; updates that land during the
+    # rebuild are replayed on top of it.
+    def __init__(self):
+        self._keys: list[tuple[int, int]] = []
+        self._counts: dict[int, int] = {}
+        self._names: dict[int, str] = {}
+        self._pending: dict[int, tuple[int, str]] | None = None
+        self.ready = False
+
+    def update(self, uid: int, invites: int, name: str = ""):
+        if self._pending is not None:
+            self._pending[uid] = (invites, name)
+        old = self._counts.pop(uid, None)
+        if old is not None:
+            del self._keys[bisect.bisect_left(self._keys, (-old, uid))]
+        if invites > 0:
+            bisect.insort(self._keys, (-invites, uid))
+            self._counts[uid] = invites
+            self._names[uid] = name or self._names.get(uid, "")
+        else:
+            self._names.pop(uid, None)
+
+    def rank(self, uid: int) -> int | None:
+        invites = self._counts.get(uid)
+        if invites is None:
+            return None
+        # Ties share a rank: count everyone with strictly more invites
+        return bisect.bisect_left(self._keys, (-invites,)) + 1
+
+    def top(self, n: int) -> list[tuple[int, int, str]]:
+        return [(uid, -neg, self._names.get(uid, "")) for neg, uid in self._keys[:n]]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    async def rebuild(self, store: UserStore, page_size: int = 500):
+        started = time.monotonic()
+        self._pending = {}
+        counts, names = {}, {}
+        try:
+            async for page in store.iter_user_pages(page_size=page_size):
+                for doc in page:
+                    invites = user_invite_count(doc)
+                    if invites > 0:
+                        uid = int(doc["$id"])
+                        counts[uid] = invites
+                        names[uid] = doc.get("first_name") or ""
+            pending = self._pending
+        except Exception as e:
+            logger.error("Leaderboard rebuild failed: %s", e)
+            return
+        finally:
+            self._pending = None
+        self._keys = sorted((-invites, uid) for uid, invites in counts.items())
+        self._counts, self._names = counts, names
+        for uid, (invites, name) in pending.items():
+            self.update(uid, invites, name)
+        self.ready = True
+        logger.info("Leaderboard built: %d referrers in %.1fs", len(self), time.monotonic() - started)
 
-_appwrite_client = Client()
-_appwrite_client.set_endpoint(APPWRITE_ENDPOINT)
-_appwrite_client.set_project(APPWRITE_PROJECT)
-_appwrite_client.set_key(APPWRITE_KEY)
-_appwrite_db = Databases(_appwrite_client)
+leaderboard = Leaderboard()
+cache_bus.on("leaderboard", leaderboard.update)
 
 # ------------------------------------------------------------------
-#  Appwrite helpers
+#  User helpers
 # ------------------------------------------------------------------
 async def get_user_doc(uid: int) -> dict | None:
+    cached = user_cache.get(uid)
+    if cached is not None:
+        return cached
+    return await load_user_doc(uid)
+
+async def load_user_doc(uid: int) -> dict | None:
+    # Store read that refills the cache; for callers that already missed it
     try:
-        res = await _appwrite_db.list_documents(
-            database_id=APPWRITE_DB,
-            collection_id=APPWRITE_COLL,
-            queries=[Query.equal("user_id", str(uid))]
-        )
-        if res["total"]:
-            return res["documents"][0]
-        return None
+        # Documents are created with document_id=str(user.id): fetch by id, no query
+        doc = await user_store.get_user(str(uid))
     except Exception as e:
         logger.error("get_user_doc error: %s", e)
         return None
+    if doc is not None:
+        user_cache.set(uid, doc)
+    return doc
 
-async def create_user_doc(user, referrer_id: int | None) -> dict:
-    doc = {
+REFERRAL_REWARD = 10
+
+def new_user_doc(user, has_seen_intro: bool = False) -> dict:
+    return {
         "user_id":        str(user.id),
         "first_name":     user.first_name,
         "username":       user.username or "",
         "start_date":     str(datetime.datetime.utcnow()),
         "referral_link":  f"https://t.me/kimemuatbot?start={user.id}",
+        "has_seen_intro": has_seen_intro,
+        "coins":          0,
+        "invite_count":   0,
+        # legacy attributes, still required by older collections
         "kimem_coins":    "0",
         "invited":        json.dumps([])
     }
+
+def _credit_later(referrer_id: int | None, user):
+    # Crediting never delays the new user's reply
+    if referrer_id and referrer_id != user.id:
+        spawn(_credit_referrer(str(referrer_id), user))
+
+async def create_user_doc(user, referrer_id: int | None) -> dict:
+    doc = new_user_doc(user)
     try:
-        created = await _appwrite_db.create_document(
-            database_id=APPWRITE_DB,
-            collection_id=APPWRITE_COLL,
-            document_id=str(user.id),
-            data=doc
-        )
-        if referrer_id and referrer_id != user.id:
-            await _credit_referrer(str(referrer_id), user)
+        created = await user_store.create_user(str(user.id), doc)
+        user_cache.set(user.id, created)
+        _credit_later(referrer_id, user)
         return created
     except Exception as e:
         logger.error("create_user_doc error: %s", e)
         return doc
 
+async def onboard_user(user, referrer_id: int | None) -> tuple[dict, bool]:
+    # /start in one Appwrite round trip: returning users are a cache hit or
+    # a get by id; new users are a single create with the intro flag set.
+    # A deep link usually means a new user, so try the create first.
+    # The cache is consulted once, so a /start counts as one hit or miss.
+    # Returns (document, created).
+    doc = user_cache.get(user.id)
+    if doc is not None:
+        return doc, False
+    if referrer_id is None:
+        doc = await load_user_doc(user.id)
+        if doc:
+            return doc, False
+    fresh = new_user_doc(user, has_seen_intro=True)
+    try:
+        created = await user_store.create_user(str(user.id), fresh)
+    except UserExists:
+        doc = await load_user_doc(user.id)
+        return (doc, False) if doc else (fresh, True)
+    except Exception as e:
+        logger.error("onboard_user error: %s", e)
+        return fresh, True
+    user_cache.set(user.id, created)
+    _credit_later(referrer_id, user)
+    return created, True
+
+async def mark_intro_seen(uid: int):
+    try:
+        await user_store.update_user(str(uid), {"has_seen_intro": True})
+        user_cache.merge(uid, {"has_seen_intro": True})
+        cache_bus.publish("user", uid, {"has_seen_intro": True})
+    except Exception as e:
+        logger.error("update has_seen_intro error: %s", e)
+
+# Documents created before invite records existed keep coins as a string
+# and invites as a JSON list; the counters are null on those.
+def is_legacy_doc(doc: dict) -> bool:
+    return doc.get("invite_count") is None
+
+def user_coins(doc: dict) -> int:
+    if doc.get("coins") is not None:
+        return int(doc["coins"])
+    return int(doc.get("kimem_coins") or 0)
+
+def user_invite_count(doc: dict) -> int:
+    if doc.get("invite_count") is not None:
+        return int(doc["invite_count"])
+    return len(json.loads(doc.get("invited") or "[]"))
+
+_crediting: set = set()
+
 async def _credit_referrer(referrer_uid: str, invitee_user):
+    if invitee_user.id in _crediting:
+        return
+    _crediting.add(invitee_user.id)
     try:
         ref_doc = await get_user_doc(int(referrer_uid))
         if not ref_doc:
             return
-        coins = int(ref_doc["kimem_coins"]) + 10
-        invited = json.loads(ref_doc["invited"])
-        invited.append({
-            "user_id": invitee_user.id,
+        invitee = {
+            "user_id": str(invitee_user.id),
             "name":    invitee_user.full_name,
-            "date":    str(datetime.datetime.utcnow())
-        })
-        await _appwrite_db.update_document(
-            database_id=APPWRITE_DB,
-            collection_id=APPWRITE_COLL,
-            document_id=referrer_uid,
-            data={"kimem_coins": str(coins), "invited": json.dumps(invited)}
-        )
+            "date":    str(datetime.datetime.utcnow()),
+        }
+        if is_legacy_doc(ref_doc):
+            # Credited by reconcile once `migrate` has upgraded the referrer
+            await user_store.record_invite(referrer_uid, invitee)
+            return
+        counters = await user_store.credit_referrer(referrer_uid, invitee, REFERRAL_REWARD)
+        if counters:
+            note_credit(referrer_uid, counters, ref_doc.get("first_name", ""))
     except Exception as e:
         logger.error("_credit_referrer error: %s", e)
+    finally:
+        _crediting.discard(invitee_user.id)
+
+def note_credit(referrer_uid: str, counters: dict, name: str):
+    user_cache.merge(int(referrer_uid), counters)
+    leaderboard.update(int(referrer_uid), counters["invite_count"], name)
+    # The referrer is usually handled by another worker
+    cache_bus.publish("user", int(referrer_uid), counters)
+    cache_bus.publish("leaderboard", int(referrer_uid), counters["invite_count"], name)
+
+async def reconcile_credits_periodically():
+    # Finishes credits left half-done by a crash or an increment that
+    # failed; runs on worker 0 only
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL)
+        try:
+            repaired = await user_store.reconcile_credits(REFERRAL_REWARD)
+        except Exception as e:
+            logger.error("Credit reconciliation failed: %s", e)
+            continue
+        for referrer_uid, counters in repaired.items():
+            ref_doc = await get_user_doc(int(referrer_uid)) or {}
+            note_credit(referrer_uid, counters, ref_doc.get("first_name", ""))
 
 async def ensure_user(user: Update.effective_user, referrer_id: int | None = None) -> dict:
     uid = user.id
@@ -120,44 +1388,291 @@ async def ensure_user(user: Update.effective_user, referrer_id: int | None = Non
     return await create_user_doc(user, referrer_id)
 
 # ------------------------------------------------------------------
-#  Existing forward maps (unchanged)
+#  Telegram file_id cache for bundled images
 # ------------------------------------------------------------------
-FORWARD_MAP = {
-    "🎯 Kimem Short Notes": ("MAIN", 7),
-    "🌐 Websites": ("MAIN", 104),
-    "📖 UAT Overview": ("MAIN", 201),
-    "❓ Frequently Asked": ("MAIN", 202),
-    "🏫 AAU Overview": ("MAIN", 301),
-    "🏢 AAU Departments": ("MAIN", 302),
-    "📍 AAU Campuses": ("MAIN", 303),
-    "🎒 Life In AAU": ("MAIN", 304),
-    "🎓 AAU After Graduation": ("MAIN", 305),
-    "🌐AAU Websites": ("MAIN", 306),
-    "🏫 ASTU Overview": ("MAIN", 311),
-    "🏢 ASTU Departments": ("MAIN", 312),
-    "📍 ASTU Campuses": ("MAIN", 313),
-    "🎒 Life In ASTU": ("MAIN", 314),
-    "🎓 ASTU After Graduation": ("MAIN", 315),
-    "🌐ASTU Websites": ("MAIN", 316),
-    "🏫 AASTU Overview": ("MAIN", 321),
-    "🏢 AASTU Departments": ("MAIN", 322),
-    "📍 AASTU Campuses": ("MAIN", 323),
-    "🎒 Life In AASTU": ("MAIN", 324),
-    "🎓 AASTU After Graduation": ("MAIN", 325),
-    "🌐AASTU Websites": ("MAIN", 326),
-    "🏥 SPHMMC Overview": ("MAIN", 331),
-    "🏢 SPHMMC Departments": ("MAIN", 332),
-    "📍 SPHMMC Campuses": ("MAIN", 333),
-    "🎒 Life In SPHMMC": ("MAIN", 334),
-    "🎓 SPHMMC After Graduation": ("MAIN", 335),
-    "🌐SPHMMC Websites": ("MAIN", 336),
-    "🏫 Bahiradar University": ("OTHERS", 401),
-    "🏫 Haramaya University": ("OTHERS", 402),
-    "🏫 Jimma University": ("OTHERS", 403),
-    "📘 AAU Last Year UAT": ("MAIN", 501),
-    "📖 AAU Model UAT": ("MAIN", 502),
-    "📚 AAU UAT Overview": ("MAIN", 503),
-    "❓ AAU UAT FAQ": ("MAIN", 504),
+def read_json_store(path: Path) -> dict:
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable store %s: %s", path, e)
+        return {}
+
+def write_json_store(path: Path, data: dict):
+    # Per-process temp name: worker processes may save the same store
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(data))
+    tmp.replace(path)
+
+class MediaCache:
+    # Maps a local asset path to the file_id Telegram assigned on first upload.
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._ids: dict[str, str] = read_json_store(self.path)
+
+    def _save(self):
+        write_json_store(self.path, self._ids)
+
+    def get(self, asset: str) -> str | None:
+        return self._ids.get(asset)
+
+    def set(self, asset: str, file_id: str):
+        if self._ids.get(asset) == file_id:
+            return
+        self._ids[asset] = file_id
+        try:
+            self._save()
+        except OSError as e:
+            logger.warning("Could not persist media cache: %s", e)
+
+    def adopt(self, asset: str, file_id: str):
+        # Learned from another worker, which already persisted it
+        self._ids[asset] = file_id
+
+    def drop(self, asset: str):
+        if self._ids.pop(asset, None) is not None:
+            try:
+                self._save()
+            except OSError as e:
+                logger.warning("Could not persist media cache: %s", e)
+
+media_cache = MediaCache(MEDIA_CACHE_PATH)
+cache_bus.on("media", media_cache.adopt)
+
+async def send_cached_photo(send, asset: str, **kwargs):
+    # `send` is reply_photo / send_photo; upload only when no valid file_id is known
+    file_id = media_cache.get(asset)
+    if file_id:
+        try:
+            return await send(photo=file_id, **kwargs)
+        except BadRequest as e:
+            logger.warning("Cached file_id for %s rejected (%s), re-uploading", asset, e)
+            media_cache.drop(asset)
+    data = await asyncio.to_thread(Path(asset).read_bytes)
+    message = await send(photo=data, **kwargs)
+    media_cache.set(asset, message.photo[-1].file_id)
+    cache_bus.publish("media", asset, message.photo[-1].file_id)
+    return message
+
+async def warm_media(bot, chat_id: str | None) -> str:
+    # Upload images that have no file_id yet into the scratch chat, so the
+    # first /start after a fresh deploy doesn't pay for the upload
+    missing = [asset for asset in (COVER_IMAGE, REFERRAL_IMAGE) if not media_cache.get(asset)]
+    if not missing:
+        return "cached"
+    if not chat_id:
+        return "skipped, CONTENT_MIRROR_CHAT_ID not set"
+
+    async def upload(asset: str):
+        message = await send_cached_photo(partial(bot.send_photo, chat_id, disable_notification=True), asset)
+        await bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+
+    await asyncio.gather(*(upload(asset) for asset in missing))
+    return f"uploaded {len(missing)}"
+
+# ------------------------------------------------------------------
+#  Content index (local mirror of forwarded channel posts)
+# ------------------------------------------------------------------
+MIRRORED_KINDS = ("photo", "document", "video", "animation", "audio", "voice")
+
+class ContentIndex:
+    # The Bot API has no getMessage, so each source post is read once by
+    # forwarding it into CONTENT_MIRROR_CHAT_ID; its file_id, caption and
+    # entities are kept and later sent directly instead of copy_message.
+    # Posts that can't be mirrored (polls, stickers) or read get a negative
+    # entry ({"kind": None}) so they go through copy_message until the TTL
+    # runs out instead of being forwarded again on every tap.
+    def __init__(self, path: str, ttl: float, mirror_chat_id: str | None):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.mirror_chat_id = mirror_chat_id
+        self._entries: dict[str, dict] = read_json_store(self.path)
+        self._refs: set[tuple[str, int]] = set()
+        self._refreshing: set[str] = set()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.mirror_chat_id)
+
+    @staticmethod
+    def _key(channel: str, msg_id: int) -> str:
+        return f"{channel}/{msg_id}"
+
+    def track(self, channel: str, msg_id: int):
+        self._refs.add((channel, msg_id))
+
+    def _save(self):
+        try:
+            write_json_store(self.path, self._entries)
+        except OSError as e:
+            logger.warning("Could not persist content index: %s", e)
+
+    @staticmethod
+    def _extract(message) -> dict | None:
+        if message.text:
+            return {
+                "kind": "text",
+                "text": message.text,
+                "entities": [e.to_dict() for e in message.entities],
+            }
+        for kind in MIRRORED_KINDS:
+            media = getattr(message, kind)
+            if media:
+                if kind == "photo":
+                    media = media[-1]
+                return {
+                    "kind": kind,
+                    "file_id": media.file_id,
+                    "text": message.caption,
+                    "entities": [e.to_dict() for e in message.caption_entities],
+                }
+        return None
+
+    async def refresh(self, bot, channel: str, msg_id: int, save: bool = True) -> dict | None:
+        key = self._key(channel, msg_id)
+        try:
+            message = await bot.forward_message(
+                chat_id=self.mirror_chat_id,
+                from_chat_id=channel,
+                message_id=msg_id,
+                disable_notification=True,
+            )
+        except TelegramError as e:
+            logger.error("Content index: cannot read %s: %s", key, e)
+            message = None
+        else:
+            try:
+                await bot.delete_message(chat_id=self.mirror_chat_id, message_id=message.message_id)
+            except TelegramError as e:
+                logger.debug("Content index: mirror cleanup failed for %s: %s", key, e)
+        entry = (message and self._extract(message)) or {"kind": None}
+        entry["fetched"] = time.time()
+        self.adopt(key, entry)
+        cache_bus.publish("content", key, entry)
+        if save:
+            self._save()
+        return entry if entry["kind"] else None
+
+    def adopt(self, key: str, entry: dict | None):
+        if entry is None:
+            self._entries.pop(key, None)
+        else:
+            self._entries[key] = entry
+
+    def _refresh_later(self, bot, channel: str, msg_id: int):
+        key = self._key(channel, msg_id)
+        if not self.enabled or key in self._refreshing:
+            return
+        self._refreshing.add(key)
+        task = spawn(self.refresh(bot, channel, msg_id))
+        task.add_done_callback(lambda _: self._refreshing.discard(key))
+
+    def _needs_refresh(self, key: str, force: bool) -> bool:
+        if key in self._refreshing:
+            return False
+        entry = self._entries.get(key)
+        return force or entry is None or time.time() - entry["fetched"] > self.ttl
+
+    async def warm(self, bot, force: bool = False, concurrency: int = 4) -> int:
+        if not self.enabled:
+            return 0
+        todo = [ref for ref in sorted(self._refs) if self._needs_refresh(self._key(*ref), force)]
+        sem = asyncio.Semaphore(concurrency)
+
+        async def _one(channel, msg_id):
+            async with sem:
+                return await self.refresh(bot, channel, msg_id, save=False)
+
+        results = await asyncio.gather(*(_one(c, m) for c, m in todo))
+        self._save()
+        indexed = sum(1 for r in results if r)
+        logger.info("Content index warmed: %d/%d refreshed, %d entries", indexed, len(todo), len(self._entries))
+        return indexed
+
+    async def send(self, bot, chat_id: int, channel: str, msg_id: int) -> bool:
+        # True when served from the index; False means "use copy_message"
+        entry = self._entries.get(self._key(channel, msg_id))
+        if entry is None:
+            self.misses += 1
+            self._refresh_later(bot, channel, msg_id)
+            return False
+        if time.time() - entry["fetched"] > self.ttl:
+            self._refresh_later(bot, channel, msg_id)
+        kind = entry["kind"]
+        if kind is None:
+            self.misses += 1
+            return False
+        entities = MessageEntity.de_list(entry["entities"], bot) or None
+        try:
+            if kind == "text":
+                await bot.send_message(chat_id=chat_id, text=entry["text"], entities=entities)
+            else:
+                await getattr(bot, f"send_{kind}")(
+                    chat_id, entry["file_id"], caption=entry["text"], caption_entities=entities
+                )
+        except BadRequest as e:
+            logger.warning("Content index entry %s/%s rejected: %s", channel, msg_id, e)
+            self._entries.pop(self._key(channel, msg_id), None)
+            self._refresh_later(bot, channel, msg_id)
+            return False
+        self.hits += 1
+        return True
+
+    def stats(self) -> dict:
+        negative = sum(1 for entry in self._entries.values() if entry["kind"] is None)
+        return {"entries": len(self._entries) - negative, "negative": negative, "tracked": len(self._refs),
+                "hits": self.hits, "misses": self.misses}
+
+content_index = ContentIndex(CONTENT_INDEX_PATH, CONTENT_INDEX_TTL, CONTENT_MIRROR_CHAT_ID)
+cache_bus.on("content", content_index.adopt)
+
+async def send_resource(bot, chat_id: int, channel: str, msg_id: int):
+    if content_index.enabled and await content_index.send(bot, chat_id, channel, msg_id):
+        return
+    await bot.copy_message(chat_id=chat_id, from_chat_id=channel, message_id=msg_id)
+
+# ------------------------------------------------------------------
+#  Existing forward maps (unchanged)
+# ------------------------------------------------------------------
+FORWARD_MAP = {
+    "🎯 Kimem Short Notes": ("MAIN", 7),
+    "🌐 Websites": ("MAIN", 104),
+    "📖 UAT Overview": ("MAIN", 201),
+    "❓ Frequently Asked": ("MAIN", 202),
+    "🏫 AAU Overview": ("MAIN", 301),
+    "🏢 AAU Departments": ("MAIN", 302),
+    "📍 AAU Campuses": ("MAIN", 303),
+    "🎒 Life In AAU": ("MAIN", 304),
+    "🎓 AAU After Graduation": ("MAIN", 305),
+    "🌐AAU Websites": ("MAIN", 306),
+    "🏫 ASTU Overview": ("MAIN", 311),
+    "🏢 ASTU Departments": ("MAIN", 312),
+    "📍 ASTU Campuses": ("MAIN", 313),
+    "🎒 Life In ASTU": ("MAIN", 314),
+    "🎓 ASTU After Graduation": ("MAIN", 315),
+    "🌐ASTU Websites": ("MAIN", 316),
+    "🏫 AASTU Overview": ("MAIN", 321),
+    "🏢 AASTU Departments": ("MAIN", 322),
+    "📍 AASTU Campuses": ("MAIN", 323),
+    "🎒 Life In AASTU": ("MAIN", 324),
+    "🎓 AASTU After Graduation": ("MAIN", 325),
+    "🌐AASTU Websites": ("MAIN", 326),
+    "🏥 SPHMMC Overview": ("MAIN", 331),
+    "🏢 SPHMMC Departments": ("MAIN", 332),
+    "📍 SPHMMC Campuses": ("MAIN", 333),
+    "🎒 Life In SPHMMC": ("MAIN", 334),
+    "🎓 SPHMMC After Graduation": ("MAIN", 335),
+    "🌐SPHMMC Websites": ("MAIN", 336),
+    "🏫 Bahiradar University": ("OTHERS", 401),
+    "🏫 Haramaya University": ("OTHERS", 402),
+    "🏫 Jimma University": ("OTHERS", 403),
+    "📘 AAU Last Year UAT": ("MAIN", 501),
+    "📖 AAU Model UAT": ("MAIN", 502),
+    "📚 AAU UAT Overview": ("MAIN", 503),
+    "❓ AAU UAT FAQ": ("MAIN", 504),
     "📝 How to Prepare For AAU": ("MAIN", 505),
     "📘 ASTU Last Year UAT": ("MAIN", 511),
     "📖 ASTU Model UAT": ("MAIN", 512),
@@ -176,425 +1691,1761 @@ FORWARD_MAP = {
     "📝 How to Prepare For SPHMMC": ("MAIN", 535),
 }
 
-MULTI_FORWARD_MAP = {
-    "📘 Text Books": [("MAIN", 10), ("MAIN", 13), ("BOOKS", 11)],
-}
+MULTI_FORWARD_MAP = {
+    "📘 Text Books": [("MAIN", 10), ("MAIN", 13), ("BOOKS", 11)],
+}
+
+# ------------------------------------------------------------------
+#  Channel membership cache
+# ------------------------------------------------------------------
+JOINED_STATUSES = {"member", "administrator", "creator"}
+
+def is_required_channel(chat) -> bool:
+    return (chat.username or "").lower() == (CHANNEL_USERNAME or "").strip().lstrip("@").lower()
+
+class MembershipCache:
+    # Joined users are trusted for longer than not-yet-joined ones, and
+    # concurrent lookups for the same user share one get_chat_member call.
+    def __init__(self, positive_ttl: float, negative_ttl: float, maxsize: int = 100_000):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self._cache = TTLCache(maxsize, positive_ttl)
+        self._inflight: dict[int, asyncio.Future] = {}
+        self.merged = 0
+
+    def record(self, user_id: int, joined: bool):
+        self._cache.set(user_id, joined, ttl=self.positive_ttl if joined else self.negative_ttl)
+
+    async def is_member(self, bot, user_id: int) -> bool:
+        cached = self._cache.get(user_id)
+        if cached is not None:
+            return cached
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._lookup(bot, user_id))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+        else:
+            self.merged += 1
+        return await asyncio.shield(task)
+
+    async def _lookup(self, bot, user_id: int) -> bool:
+        member = await bot.get_chat_member(chat_id=CHANNEL_USERNAME, user_id=user_id)
+        joined = member.status in JOINED_STATUSES
+        self.record(user_id, joined)
+        return joined
+
+    def stats(self) -> dict:
+        return {**self._cache.stats(), "merged": self.merged}
+
+membership_cache = MembershipCache(MEMBER_TTL_POSITIVE, MEMBER_TTL_NEGATIVE)
+cache_bus.on("member", membership_cache.record)
+
+async def channel_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Only delivered when the bot is an admin of the channel
+    change = update.chat_member
+    if not is_required_channel(change.chat):
+        return
+    member = change.new_chat_member
+    joined = member.status in JOINED_STATUSES
+    membership_cache.record(member.user.id, joined)
+    cache_bus.publish("member", member.user.id, joined)
+
+# ------------------------------------------------------------------
+#  Start / Intro flow
+# ------------------------------------------------------------------
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    referrer_id = None
+    if context.args and context.args[0].isdigit():
+        referrer_id = int(context.args[0])
+
+    user_data, created = await onboard_user(user, referrer_id)
+
+    if not created and referrer_id is None and user_data.get("has_seen_intro"):
+        await update.message.reply_text(f"Welcome back, {user.first_name}! 👋")
+        await send_home_menu(update, context)
+        return
+
+    # Mark intro shown (new documents already carry the flag)
+    if not user_data.get("has_seen_intro"):
+        spawn(mark_intro_seen(user.id))
+
+    keyboard = [[InlineKeyboardButton("Okay Continue.", callback_data="continue")]]
+    await send_cached_photo(
+        update.message.reply_photo,
+        COVER_IMAGE,
+        caption="Welcome to Kimem UAT your gateway to AAU, ASTU, AASTU and SPHMMC",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def continue_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await query.message.delete()
+
+    username = query.from_user.username or query.from_user.first_name
+    keyboard = [
+        [InlineKeyboardButton("Join Channel", url=f"https://t.me/{CHANNEL_USERNAME.strip('@')}")],
+        [InlineKeyboardButton("Confirm Join", callback_data="check_join")]
+    ]
+    await send_cached_photo(
+        query.message.chat.send_photo,
+        COVER_IMAGE,
+        caption=f"Hey There '{username}' Welcome to Kimem UAT, We are here to guide you through the UAT journey for free. Please join the following channel First.",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def check_join_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await query.answer()
+
+    try:
+        if await membership_cache.is_member(context.bot, user_id):
+            await query.message.delete()
+            await send_home_menu(update, context)
+        else:
+            await query.message.reply_text("❌ You haven't joined the channel yet.")
+    except Exception as e:
+        logger.error("Error checking membership: %s", e)
+        await query.message.reply_text("⚠️ Could not verify your channel join. Please try again later.")
+
+# ------------------------------------------------------------------
+#  Menu tree
+# ------------------------------------------------------------------
+NAV_ROW        = ["⬅ Back", "🏠Home"]
+MAX_NAV_DEPTH  = 8
+
+HOME_ROWS = [
+    ["💰 Referral","📚 UAT Preparation"],
+    ["🗂️ Resources", "🏛️ About AAU"],
+    ["🏫 About ASTU", "🏫 About AASTU", "🏥 About SPHMMC"],
+    ["🎓 Other Universities", "ℹ️ About Kimem UAT"]
+]
+
+# name -> (home-menu button, has a UAT section); adding a university here
+# (plus its FORWARD_MAP entries) is all it takes to get both sub-menus.
+UNIVERSITIES = {
+    "AAU":    ("🏛️ About AAU", True),
+    "ASTU":   ("🏫 About ASTU", True),
+    "AASTU":  ("🏫 About AASTU", True),
+    "SPHMMC": ("🏥 About SPHMMC", False),
+}
+
+class Menu(NamedTuple):
+    title: str
+    markup: ReplyKeyboardMarkup
+
+def _menu_specs():
+    # (menu id, button that opens it, title, rows)
+    yield "HOME", "🏠Home", "🏠 You are back home. Use the options below:", HOME_ROWS
+    yield "UAT_PREPARATION", "📚 UAT Preparation", (
+        "📘 UAT Preparation Section\nChoose the university or topic you want to explore:"
+    ), [
+        ["❓ What is UAT?", "🏛 AAU UAT"],
+        ["🏫 AASTU & ASTU UAT", "🏥 SPHMMC Entrance"],
+    ]
+    yield "RESOURCES", "🗂️ Resources", (
+        "🗂️ Resources Section:\nSelect a category to explore useful learning materials."
+    ), [
+        ["🎯 Kimem Short Notes","📘 Text Books"],
+        ["📚 SAT Collection","🌐 Websites"],
+    ]
+    yield "OTHER_UNIVERSITIES", "🎓 Other Universities", (
+        "🎓 Other Universities Section:\nSelect a university to learn more."
+    ), [
+        ["🏫 Bahiradar University"],
+        ["🏫 Haramaya University"],
+        ["🏫 Jimma University"],
+    ]
+    yield "WHAT_IS_UAT", "❓ What is UAT?", "Choose an option to learn about UAT:", [
+        ["📖 UAT Overview"],
+        ["❓ Frequently Asked"],
+    ]
+    yield "AASTU_ASTU_UAT", "🏫 AASTU & ASTU UAT", (
+        "🏫 AASTU & ASTU UAT Section:\nChoose an option to explore:"
+    ), [
+        ["📘 AASTU & ASTU Last Year UAT", "📖 AASTU & ASTU Model UAT"],
+        ["📚 AASTU & ASTU UAT Overview","❓ AASTU & ASTU UAT FAQ"],
+        ["📝 How to Prepare For AASTU & ASTU"],
+    ]
+    yield "SPHMMC_ENTRANCE", "🏥 SPHMMC Entrance", (
+        "🏥 SPHMMC Entrance Section:\nChoose an option to explore:"
+    ), [
+        ["📘 SPHMMC Last Year Exam", "📖 SPHMMC Model Exam"],
+        ["📚 SPHMMC Exam Overview", "❓ SPHMMC Exam FAQ"],
+        ["📝 How to Prepare For SPHMMC"],
+    ]
+    for name, (about_button, has_uat) in UNIVERSITIES.items():
+        yield f"ABOUT_{name}", about_button, f"🏛️ About {name} Section:\nSelect an option to learn more.", [
+            [f"🏫 {name} Overview", f"🏢 {name} Departments"],
+            [f"📍 {name} Campuses", f"🎒 Life In {name}"],
+            [f"🎓 {name} After Graduation", f"🌐{name} Websites"],
+        ]
+        if has_uat:
+            yield f"UAT_{name}", f"🏛 {name} UAT", f"🏛 {name} UAT Section:\nChoose an option to explore:", [
+                [f"📘 {name} Last Year UAT", f"📖 {name} Model UAT"],
+                [f"📚 {name} UAT Overview", f"❓ {name} UAT FAQ"],
+                [f"📝 How to Prepare For {name}"],
+            ]
+
+def build_menu_tree() -> tuple[dict, dict]:
+    menus, buttons = {}, {}
+    for menu_id, button, title, rows in _menu_specs():
+        if menu_id != "HOME":
+            rows = rows + [NAV_ROW]
+        menus[menu_id] = Menu(title, ReplyKeyboardMarkup(rows, resize_keyboard=True))
+        buttons[button] = menu_id
+    return menus, buttons
+
+MENUS, MENU_BUTTONS = build_menu_tree()
+
+async def nav_stack(update: Update) -> list:
+    # Persisted through user_state; call user_state.changed() after editing
+    state = await user_state.get(update.effective_user.id)
+    return state.setdefault("nav", [])
+
+async def render_menu(update: Update, menu_id: str):
+    menu = MENUS[menu_id]
+    # send_message rather than reply_text: callback updates have no message to reply to
+    await update.effective_chat.send_message(menu.title, reply_markup=menu.markup)
+
+async def show_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, menu_id: str):
+    nav = await nav_stack(update)
+    if nav or menu_id != "HOME":
+        user_state.changed(update.effective_user.id)
+    if menu_id == "HOME":
+        nav.clear()
+    elif menu_id in nav:
+        del nav[nav.index(menu_id) + 1:]
+    else:
+        nav.append(menu_id)
+        del nav[:-MAX_NAV_DEPTH]
+    await render_menu(update, menu_id)
+
+async def send_home_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await show_menu(update, context, "HOME")
+
+async def universal_back_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    nav = await nav_stack(update)
+    if nav:
+        nav.pop()
+        user_state.changed(update.effective_user.id)
+    await render_menu(update, nav[-1] if nav else "HOME")
+
+# ------------------------------------------------------------------
+#  Referral section
+# ------------------------------------------------------------------
+INVITES_PAGE_SIZE = 10
+
+LEADERBOARD_SIZE = 10
+
+REFERRAL_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Your invites", callback_data="show_invites"),
+     InlineKeyboardButton("🏆 Top inviters", callback_data="leaderboard")],
+    [InlineKeyboardButton("Developer's Channel", url="https://t.me/yosdevhub")],
+])
+
+def rank_line(uid: int) -> str:
+    rank = leaderboard.rank(uid) if leaderboard.ready else None
+    return f"Your rank: #{rank} of {len(leaderboard)} inviters\n" if rank else ""
+
+def referral_caption(user, user_doc: dict) -> str:
+    return (
+        f"Hello {user.first_name};\n"
+        f"--------------------------------\n"
+        f"You have invited: {user_invite_count(user_doc)} people\n"
+        f"You have: {user_coins(user_doc)} Kimem Coins\n"
+        f"{rank_line(user.id)}"
+        f"----------------------------------\n"
+        f"Your invite link:\n{user_doc['referral_link']}\n"
+        f"---------------------------------------\n"
+        f"Get {REFERRAL_REWARD} Coins per person you invite\n"
+        f"Collect Kimem Coins and get my paid Telegram Bot and Website Development Courses for free. "
+        f"The coins will be listed after the UAT exam."
+    )
+
+async def referral_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    user_doc = await ensure_user(user)
+    await send_cached_photo(
+        update.message.reply_photo,
+        REFERRAL_IMAGE,
+        caption=referral_caption(user, user_doc),
+        reply_markup=REFERRAL_KEYBOARD,
+    )
+
+async def fetch_invites_page(referrer_id: str, direction: str, cursor: str | None) -> tuple[list, bool]:
+    # Keyset pagination over the invite records: one bounded query per tap
+    if direction == "p":
+        docs = await user_store.list_invites(referrer_id, before=cursor, limit=INVITES_PAGE_SIZE)
+    else:
+        docs = await user_store.list_invites(referrer_id, after=cursor, limit=INVITES_PAGE_SIZE + 1)
+    more = len(docs) > INVITES_PAGE_SIZE
+    return docs[:INVITES_PAGE_SIZE], more
+
+async def show_invites_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # callback_data: "show_invites" or "show_invites:<n|p>:<cursor id>:<page>"
+    query = update.callback_query
+    user_id = query.from_user.id
+    await query.answer()
+
+    parts = query.data.split(":")
+    direction, cursor, page = ("n", None, 0) if len(parts) != 4 else (parts[1], parts[2], int(parts[3]))
+
+    user_doc = await get_user_doc(user_id)
+    invited, has_next = [], False
+    try:
+        if user_doc and is_legacy_doc(user_doc):
+            # Not migrated yet: page through the JSON list by page number
+            everyone = json.loads(user_doc.get("invited") or "[]")
+            start = page * INVITES_PAGE_SIZE
+            invited = [
+                {"$id": str(inv["user_id"]), "name": inv.get("name", ""), "date": inv.get("date", "")}
+                for inv in everyone[start:start + INVITES_PAGE_SIZE]
+            ]
+            has_next = len(everyone) > start + INVITES_PAGE_SIZE
+        elif user_doc and user_invite_count(user_doc):
+            invited, more = await fetch_invites_page(str(user_id), direction, cursor)
+            # Coming back from a later page there is always a next one
+            has_next = more if direction == "n" else True
+    except Exception as e:
+        logger.error("list_invites error: %s", e)
+
+    keyboard = []
+    if not invited:
+        text = "You haven't invited anyone yet."
+    else:
+        total = user_invite_count(user_doc)
+        pages = max(1, -(-total // INVITES_PAGE_SIZE))
+        lines = [f"📋 Invites list ({total} total) – page {page + 1}/{pages}:"]
+        for inv in invited:
+            lines.append(f"• {inv['name']} – {inv['date'][:10]}")
+        text = "\n".join(lines)
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton(
+                "◀ Prev", callback_data=f"show_invites:p:{invited[0]['$id']}:{page - 1}"
+            ))
+        if has_next:
+            nav.append(InlineKeyboardButton(
+                "Next ▶", callback_data=f"show_invites:n:{invited[-1]['$id']}:{page + 1}"
+            ))
+        if nav:
+            keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("⬅ Go Back", callback_data="referral_back")])
+    try:
+        await query.message.edit_caption(caption=text, reply_markup=InlineKeyboardMarkup(keyboard))
+    except Exception as e:
+        logger.error("Failed to edit caption: %s", e)
+        await query.message.reply_text(text)
+
+async def referral_back_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user = query.from_user
+    user_doc = await get_user_doc(user.id)
+    caption = referral_caption(user, user_doc)
+    try:
+        await query.message.edit_caption(caption=caption, reply_markup=REFERRAL_KEYBOARD)
+    except Exception as e:
+        logger.error("Failed to go back to referral screen: %s", e)
+        await query.message.reply_text(caption)
+
+def leaderboard_text(uid: int) -> str:
+    if not leaderboard.ready:
+        return "🏆 The leaderboard is being computed, try again in a minute."
+    lines = ["🏆 Top inviters", ""]
+    medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+    for position, (_, invites, name) in enumerate(leaderboard.top(LEADERBOARD_SIZE), 1):
+        lines.append(f"{medals.get(position, f'{position}.')} {name or 'Anonymous'} — {invites} invites")
+    if len(lines) == 2:
+        lines.append("No invites yet. Be the first!")
+    rank = leaderboard.rank(uid)
+    lines += ["", f"You are #{rank} of {len(leaderboard)}." if rank else "Invite friends to get ranked."]
+    return "\n".join(lines)
+
+async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(leaderboard_text(update.effective_user.id))
+
+async def leaderboard_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await update.effective_chat.send_message(leaderboard_text(query.from_user.id))
+
+# ------------------------------------------------------------------
+#  About Kimem UAT
+# ------------------------------------------------------------------
+ABOUT_KIMEM_MSG_ID = 6
+
+async def about_kimem_uat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    db_channel = DB_CHANNEL_USERNAME
+    if not db_channel:
+        await update.message.reply_text("⚠️ Channel not configured.")
+        return
+    try:
+        await send_resource(context.bot, update.effective_chat.id, db_channel, ABOUT_KIMEM_MSG_ID)
+    except Exception as e:
+        logger.error("Error copying message: %s", e)
+        await update.message.reply_text("⚠️ Could not retrieve info. Please try again later.")
+
+# ------------------------------------------------------------------
+#  Forward-map generators (unchanged except async)
+# ------------------------------------------------------------------
+def make_forwarder(channel_key: str, msg_id: int):
+    env_key = f"DB_{channel_key}_CHANNEL_USERNAME"
+    channel = os.getenv(env_key)
+    if not channel:
+        logger.warning("Env var %s not set – skipping some handlers", env_key)
+        return None
+    content_index.track(channel, msg_id)
+
+    async def _handler(update: Update, _: ContextTypes.DEFAULT_TYPE):
+        try:
+            await send_resource(update.get_bot(), update.effective_chat.id, channel, msg_id)
+        except Exception as e:
+            logger.error("Error forwarding %s/%s: %s", channel_key, msg_id, e)
+            await update.message.reply_text("⚠️ Could not retrieve info.")
+    return _handler
+
+FORWARD_RETRIES = 2
+
+async def _copy_group(bot, chat_id: int, channel: str, ids: list[int]) -> bool:
+    for attempt in range(FORWARD_RETRIES + 1):
+        try:
+            if len(ids) == 1:
+                await bot.copy_message(chat_id=chat_id, from_chat_id=channel, message_id=ids[0])
+            else:
+                await bot.copy_messages(chat_id=chat_id, from_chat_id=channel, message_ids=ids)
+            return True
+        except BadRequest as e:
+            # BadRequest subclasses NetworkError but retrying can't help;
+            # one bad id rejects the whole group, so fall back below
+            logger.error("Bulk copy %s%s rejected: %s", channel, ids, e)
+            break
+        except TimedOut as e:
+            # The copy may well have gone through; resending would duplicate it
+            logger.error("Copy %s%s timed out, not retrying: %s", channel, ids, e)
+            return False
+        except NetworkError as e:
+            logger.warning("Copy %s%s failed (attempt %d): %s", channel, ids, attempt + 1, e)
+            if attempt < FORWARD_RETRIES:
+                await asyncio.sleep(0.5 * 2 ** attempt)
+        except TelegramError as e:
+            # Forbidden and friends: every single copy would fail the same way
+            logger.error("Bulk copy %s%s rejected: %s", channel, ids, e)
+            return False
+    else:
+        return False
+    if len(ids) == 1:
+        return False
+    # Isolate the failing part: retry the group message by message
+    ok = True
+    for msg_id in ids:
+        try:
+            await bot.copy_message(chat_id=chat_id, from_chat_id=channel, message_id=msg_id)
+        except TelegramError as e:
+            logger.error("Error forwarding %s/%s: %s", channel, msg_id, e)
+            ok = False
+    return ok
+
+def make_multi_forwarder(entries):
+    channels = {}
+    for key, _ in entries:
+        env_key = f"DB_{key}_CHANNEL_USERNAME"
+        channels[key] = os.getenv(env_key)
+        if channels[key] is None:
+            logger.warning("Missing env var %s – skipped multi-forward", env_key)
+            return None
+
+    # One copy_messages call per source channel (ids must be increasing and
+    # keep that order in the chat); different channels go out concurrently.
+    groups: dict[str, list[int]] = {}
+    for key, msg_id in entries:
+        groups.setdefault(channels[key], []).append(msg_id)
+    groups = {channel: sorted(set(ids)) for channel, ids in groups.items()}
+
+    async def _handler(update: Update, _: ContextTypes.DEFAULT_TYPE):
+        bot = update.get_bot()
+        chat_id = update.effective_chat.id
+        results = await asyncio.gather(*(
+            _copy_group(bot, chat_id, channel, ids) for channel, ids in groups.items()
+        ))
+        if not all(results):
+            await update.message.reply_text("⚠️ Could not retrieve info.")
+    return _handler
+
+# ------------------------------------------------------------------
+#  Text router
+# ------------------------------------------------------------------
+TEXT_ROUTES: dict = {}
+
+def build_text_routes() -> dict:
+    routes = {
+        "💰 Referral": referral_handler,
+        "ℹ️ About Kimem UAT": about_kimem_uat_handler,
+        "⬅ Back": universal_back_handler,
+    }
+    for button, menu_id in MENU_BUTTONS.items():
+        routes[button] = partial(show_menu, menu_id=menu_id)
+
+    for text, (key, mid) in FORWARD_MAP.items():
+        handler_fn = make_forwarder(key, mid)
+        if handler_fn:
+            routes[text] = handler_fn
+
+    for button_text, entries in MULTI_FORWARD_MAP.items():
+        handler_fn = make_multi_forwarder(entries)
+        if handler_fn:
+            routes[button_text] = handler_fn
+    return {text: instrument_handler(text, fn) for text, fn in routes.items()}
+
+async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    handler = TEXT_ROUTES.get(update.effective_message.text)
+    if handler is None:
+        # Free text or a stale keyboard button: nothing to do
+        logger.debug("No route for text %r", update.effective_message.text)
+        return
+    await handler(update, context)
+
+# ------------------------------------------------------------------
+#  Duplicate tap suppression
+# ------------------------------------------------------------------
+class TapDeduplicator:
+    # A request identical to one of the same user's (same text or callback
+    # data) is dropped while that one is still running, or within `window`
+    # seconds after it finished. Dropped callback queries are still answered
+    # so the button stops spinning. Updates of one chat run in order, so most
+    # duplicates arrive just after the original and fall in the window.
+    MAX_ENTRIES = 10_000
+
+    def __init__(self, window: float, exempt: tuple = ()):
+        self.window = window
+        self.exempt = set(exempt)
+        self._inflight: set[tuple] = set()
+        self._finished: dict[tuple, float] = {}
+        self.executed = 0
+        self.inflight_dropped = 0
+        self.debounced = 0
+
+    def _key(self, update: object) -> tuple | None:
+        if not isinstance(update, Update) or update.effective_user is None:
+            return None
+        if update.callback_query:
+            payload = update.callback_query.data
+        elif update.message and update.message.text:
+            payload = update.message.text
+        else:
+            return None
+        if payload in self.exempt:
+            return None
+        return update.effective_user.id, payload
+
+    def _prune(self, now: float):
+        if len(self._finished) > self.MAX_ENTRIES:
+            self._finished = {k: t for k, t in self._finished.items() if now - t < self.window}
+
+    def wrap(self, callback):
+        async def deduped(update, context):
+            key = self._key(update) if self.window > 0 else None
+            if key is None:
+                return await callback(update, context)
+            if key in self._inflight:
+                self.inflight_dropped += 1
+                reason = "inflight"
+            elif time.monotonic() - self._finished.get(key, float("-inf")) < self.window:
+                self.debounced += 1
+                reason = "debounced"
+            else:
+                reason = None
+            if reason:
+                metrics.inc("kimem_duplicate_taps_total", reason=reason)
+                if update.callback_query:
+                    try:
+                        await update.callback_query.answer()
+                    except TelegramError:
+                        pass
+                return
+            self.executed += 1
+            self._inflight.add(key)
+            try:
+                return await callback(update, context)
+            finally:
+                self._inflight.discard(key)
+                now = time.monotonic()
+                self._finished[key] = now
+                self._prune(now)
+        deduped.__name__ = callback.__name__
+        return deduped
+
+    def stats(self) -> dict:
+        dropped = self.inflight_dropped + self.debounced
+        seen = self.executed + dropped
+        return {
+            "executed": self.executed,
+            "inflight_dropped": self.inflight_dropped,
+            "debounced": self.debounced,
+            "dropped_rate": dropped / seen if seen else 0.0,
+        }
+
+# "⬅ Back" twice in a row is a deliberate two-level jump, not a duplicate
+tap_dedup = TapDeduplicator(DEBOUNCE_WINDOW, exempt=("⬅ Back",))
+metrics.describe("kimem_duplicate_taps_total", "counter", "Repeated taps dropped before reaching a handler")
+
+# ------------------------------------------------------------------
+#  Concurrent update processing
+# ------------------------------------------------------------------
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # Different chats run concurrently; updates of one chat keep their order
+    # so a user's menu stack never sees interleaved handlers.
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._waiters: dict[int, int] = {}
+
+    @staticmethod
+    def _key(update: object):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    async def process_update(self, update: object, coroutine):
+        # The chat lock is taken before a concurrency slot, so only the head
+        # update of each chat holds one; a backlog in one chat waits on its
+        # own lock instead of filling every slot and stalling other chats.
+        key = self._key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# ------------------------------------------------------------------
+#  Outbound send scheduler
+# ------------------------------------------------------------------
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK        = 1
+# Only methods that post into a chat count against its per-chat limit;
+# lookups like getChatMember on the channel just share the global bucket.
+CHAT_LIMITED_PREFIXES = ("send", "copyMessage", "forwardMessage", "edit")
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    delay = error.retry_after
+    if isinstance(delay, datetime.timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def reserve(self) -> float:
+        # Take a token now (possibly going negative) and return how long to
+        # wait for it; concurrent callers are served in arrival order.
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity and self.blocked_until <= self.updated
+
+class SendScheduler(BaseRateLimiter):
+    # Every Bot API call passes through here: a per-chat bucket first, then a
+    # global bucket handed out in priority order (interactive before bulk).
+    # RetryAfter pauses the affected bucket and the request is requeued.
+    # Bulk senders pass rate_limit_args={"priority": PRIORITY_BULK}.
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float,
+                 group_rate: float, max_retries: int):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: dict = {}
+        self._queue: list = []
+        self._seq = 0
+        self._wake = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+        self.chat_waiters = 0
+        self.sent = 0
+        self.retry_after = 0
+        self.wait_total = [0.0, 0.0]
+        self.wait_max = [0.0, 0.0]
+        self.wait_count = [0, 0]
+
+    async def initialize(self):
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        for _, _, fut in self._queue:
+            fut.cancel()
+        self._queue.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10_000:
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle()}
+            private = isinstance(chat_id, int) and chat_id > 0
+            if private:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            else:
+                bucket = TokenBucket(self.group_rate, 1)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _dispatch(self):
+        while True:
+            while not self._queue:
+                self._wake.clear()
+                await self._wake.wait()
+            if self._queue[0][2].done():
+                heapq.heappop(self._queue)
+                continue
+            delay = self._global.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            self._global.take()
+            _, _, fut = heapq.heappop(self._queue)
+            fut.set_result(None)
+
+    async def _acquire(self, chat_id, priority: int):
+        started = time.monotonic()
+        if chat_id is not None:
+            self.chat_waiters += 1
+            try:
+                wait = self._chat_bucket(chat_id).reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            finally:
+                self.chat_waiters -= 1
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._queue, (priority, self._seq, fut))
+        self._wake.set()
+        await fut
+        waited = time.monotonic() - started
+        metrics.observe("kimem_send_wait_seconds", waited,
+                        priority="bulk" if priority == PRIORITY_BULK else "interactive")
+        self.wait_total[priority] += waited
+        self.wait_count[priority] += 1
+        self.wait_max[priority] = max(self.wait_max[priority], waited)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        rate_limit_args = rate_limit_args or {}
+        priority = rate_limit_args.get("priority", PRIORITY_INTERACTIVE)
+        max_retries = rate_limit_args.get("max_retries", self.max_retries)
+        chat_id = data.get("chat_id") if endpoint.startswith(CHAT_LIMITED_PREFIXES) else None
+        for attempt in range(max_retries + 1):
+            await self._acquire(chat_id, priority)
+            started = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                self.retry_after += 1
+                metrics.inc("kimem_bot_api_retry_after_total", method=endpoint)
+                delay = retry_after_seconds(e)
+                bucket = self._global if chat_id is None else self._chat_bucket(chat_id)
+                bucket.block(delay)
+                if attempt == max_retries:
+                    raise
+                logger.warning("%s hit flood control for %s, retrying in %.1fs", endpoint, chat_id, delay)
+            except TelegramError:
+                metrics.inc("kimem_bot_api_errors_total", method=endpoint)
+                raise
+            finally:
+                metrics.observe("kimem_bot_api_duration_seconds", time.perf_counter() - started, method=endpoint)
+
+    def share_global(self, processes: int):
+        # Worker processes each get an equal slice of the bot-wide limit
+        rate = self._global.rate / processes
+        self._global = TokenBucket(rate, max(rate, 1))
+
+    def queue_depth(self) -> int:
+        return len(self._queue) + self.chat_waiters
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth(),
+            "sent": self.sent,
+            "retry_after": self.retry_after,
+            "avg_wait_interactive": self.wait_total[0] / self.wait_count[0] if self.wait_count[0] else 0.0,
+            "avg_wait_bulk": self.wait_total[1] / self.wait_count[1] if self.wait_count[1] else 0.0,
+            "max_wait_interactive": self.wait_max[0],
+            "max_wait_bulk": self.wait_max[1],
+        }
+
+send_scheduler = SendScheduler(
+    SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_GROUP_RATE, SEND_MAX_RETRIES
+)
+
+# ------------------------------------------------------------------
+#  Broadcast
+# ------------------------------------------------------------------
+async def set_blocked(uid: str, blocked: bool):
+    try:
+        await user_store.update_user(uid, {"blocked": blocked})
+        user_cache.merge(int(uid), {"blocked": blocked})
+        cache_bus.publish("user", int(uid), {"blocked": blocked})
+    except Exception as e:
+        logger.error("set_blocked error for %s: %s", uid, e)
+
+def format_duration(seconds: float | None) -> str:
+    if seconds is None:
+        return "?"
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{secs:02d}s"
+
+class Broadcast:
+    # Copies one admin message to every user. Users are streamed page by page
+    # and sent through the send scheduler at bulk priority by up to
+    # BROADCAST_WORKERS concurrent senders. The cursor and counters are
+    # checkpointed after every page, so a resumed run restarts at the first
+    # unfinished page: nobody is skipped, at most one page is sent twice.
+    def __init__(self, bot, state: dict, path: Path):
+        self.bot = bot
+        self.state = state
+        self.path = path
+        self.cancelled = False
+        self.task: asyncio.Task | None = None
+        self._sem = asyncio.Semaphore(BROADCAST_WORKERS)
+        self._started = time.monotonic()
+        self._done_at_start = self.done
+
+    @classmethod
+    def new(cls, bot, path: Path, source, total: int) -> "Broadcast":
+        state = {
+            "from_chat_id": source.chat_id, "message_id": source.message_id,
+            "cursor": None, "total": total,
+            "sent": 0, "blocked": 0, "failed": 0, "skipped": 0,
+        }
+        return cls(bot, state, path)
+
+    @property
+    def done(self) -> int:
+        return sum(self.state[k] for k in ("sent", "blocked", "failed", "skipped"))
+
+    def progress(self) -> str:
+        s = self.state
+        elapsed = time.monotonic() - self._started
+        rate = (self.done - self._done_at_start) / elapsed if elapsed > 0 else 0.0
+        remaining = max(0, s["total"] - self.done)
+        eta = remaining / rate if rate else None
+        pct = 100 * self.done / s["total"] if s["total"] else 100.0
+        return (
+            f"Progress: {self.done}/{s['total']} ({min(pct, 100):.1f}%)\n"
+            f"Sent: {s['sent']} · Blocked: {s['blocked']} · Failed: {s['failed']} · Skipped: {s['skipped']}\n"
+            f"Speed: {rate:.1f} msg/s · ETA: {format_duration(eta)}"
+        )
+
+    def _checkpoint(self):
+        write_json_store(self.path, self.state)
+
+    async def _send(self, uid: str):
+        async with self._sem:
+            try:
+                await self.bot.copy_message(
+                    chat_id=int(uid),
+                    from_chat_id=self.state["from_chat_id"],
+                    message_id=self.state["message_id"],
+                    rate_limit_args={"priority": PRIORITY_BULK},
+                )
+                self.state["sent"] += 1
+            except Forbidden:
+                # Blocked the bot or deactivated: skip them next time
+                self.state["blocked"] += 1
+                spawn(set_blocked(uid, True))
+            except TelegramError as e:
+                self.state["failed"] += 1
+                logger.warning("Broadcast to %s failed: %s", uid, e)
+
+    async def _report(self, chat_id: int, title: str):
+        text = f"📣 {title}\n{self.progress()}"
+        logger.info("Broadcast: %s", text.replace("\n", " | "))
+        try:
+            await self.bot.send_message(chat_id, text)
+        except TelegramError as e:
+            logger.warning("Broadcast report failed: %s", e)
 
-PATTERN_BACK = "^⬅ Back$"
+    async def _report_loop(self, chat_id: int):
+        while True:
+            await asyncio.sleep(BROADCAST_REPORT_INTERVAL)
+            await self._report(chat_id, "Broadcast running")
 
-# ------------------------------------------------------------------
-#  Helper utilities
-# ------------------------------------------------------------------
-def set_user_state(context: ContextTypes.DEFAULT_TYPE, menu: str):
-    context.user_data["prev_menu"] = menu
+    async def run(self, report_chat_id: int):
+        reporter = spawn(self._report_loop(report_chat_id))
+        try:
+            async for page in user_store.iter_user_pages(after=self.state["cursor"], page_size=BROADCAST_PAGE_SIZE):
+                targets = [doc["$id"] for doc in page if not doc.get("blocked")]
+                self.state["skipped"] += len(page) - len(targets)
+                await asyncio.gather(*(self._send(uid) for uid in targets))
+                self.state["cursor"] = page[-1]["$id"]
+                self._checkpoint()
+                if self.cancelled:
+                    break
+        except Exception as e:
+            logger.error("Broadcast stopped at %s: %s", self.state["cursor"], e)
+            await self._report(report_chat_id, f"Broadcast stopped ({e}); /broadcast resume to continue")
+            return
+        finally:
+            reporter.cancel()
+        if self.cancelled:
+            await self._report(report_chat_id, "Broadcast paused; /broadcast resume to continue")
+        else:
+            self.path.unlink(missing_ok=True)
+            await self._report(report_chat_id, "Broadcast finished")
 
-# ------------------------------------------------------------------
-#  Start / Intro flow
-# ------------------------------------------------------------------
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    referrer_id = None
-    if context.args and context.args[0].isdigit():
-        referrer_id = int(context.args[0])
+BROADCAST_USAGE = (
+    "Reply to the message to send with /broadcast.\n"
+    "/broadcast status – progress of the running broadcast\n"
+    "/broadcast cancel – pause it (resumable)\n"
+    "/broadcast resume – continue an interrupted broadcast\n"
+    "/broadcast discard – drop an interrupted broadcast"
+)
 
-    user_data = await ensure_user(user, referrer_id)
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    action = context.args[0].lower() if context.args else ""
+    path = Path(BROADCAST_CHECKPOINT_PATH)
+    running = context.bot_data.get("broadcast")
+    if running is not None and running.task.done():
+        running = None
 
-    if referrer_id is None and user_data.get("has_seen_intro"):
-        await update.message.reply_text(f"Welcome back, {user.first_name}! 👋")
-        await send_home_menu(update, context)
+    if action == "status":
+        await update.message.reply_text(running.progress() if running else "No broadcast running.")
+        return
+    if action == "cancel":
+        if running:
+            running.cancelled = True
+            await update.message.reply_text("⏸ Pausing after the current page...")
+        else:
+            await update.message.reply_text("No broadcast running.")
+        return
+    if running:
+        await update.message.reply_text("A broadcast is already running.\n" + running.progress())
+        return
+    checkpoint = read_json_store(path)
+    if action == "discard":
+        path.unlink(missing_ok=True)
+        await update.message.reply_text("🗑 Interrupted broadcast discarded." if checkpoint else "Nothing to discard.")
         return
 
-    # Mark intro shown
-    try:
-        await _appwrite_db.update_document(
-            database_id=APPWRITE_DB,
-            collection_id=APPWRITE_COLL,
-            document_id=str(user.id),
-            data={"has_seen_intro": True}
+    if action == "resume":
+        if not checkpoint:
+            await update.message.reply_text("Nothing to resume.")
+            return
+        broadcast = Broadcast(context.bot, checkpoint, path)
+        title = "Broadcast resumed"
+    elif update.message.reply_to_message is None:
+        await update.message.reply_text(BROADCAST_USAGE)
+        return
+    elif checkpoint:
+        await update.message.reply_text(
+            "An interrupted broadcast exists: /broadcast resume or /broadcast discard first."
         )
-    except Exception as e:
-        logger.error("update has_seen_intro error: %s", e)
+        return
+    else:
+        total = await user_store.count_users()
+        broadcast = Broadcast.new(context.bot, path, update.message.reply_to_message, total)
+        broadcast._checkpoint()
+        title = "Broadcast started"
 
-    keyboard = [[InlineKeyboardButton("Okay Continue.", callback_data="continue")]]
-    with open("img/cover.png", "rb") as image:
-        await update.message.reply_photo(
-            photo=image,
-            caption="Welcome to Kimem UAT your gateway to AAU, ASTU, AASTU and SPHMMC",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    broadcast.task = spawn(broadcast.run(update.effective_chat.id))
+    context.bot_data["broadcast"] = broadcast
+    await update.message.reply_text(f"📣 {title}\n{broadcast.progress()}")
 
-async def continue_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.message.delete()
+async def bot_status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # The bot's own membership in a private chat: kicked means blocked
+    change = update.my_chat_member
+    if change.chat.type != "private":
+        return
+    blocked = change.new_chat_member.status == "kicked"
+    if blocked != (change.old_chat_member.status == "kicked"):
+        await set_blocked(str(change.chat.id), blocked)
 
-    username = query.from_user.username or query.from_user.first_name
-    keyboard = [
-        [InlineKeyboardButton("Join Channel", url=f"https://t.me/{CHANNEL_USERNAME.strip('@')}")],
-        [InlineKeyboardButton("Confirm Join", callback_data="check_join")]
-    ]
-    with open("img/cover.png", "rb") as image:
-        await query.message.chat.send_photo(
-            photo=image,
-            caption=f"Hey There '{username}' Welcome to Kimem UAT, We are here to guide you through the UAT journey for free. Please join the following channel First.",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+# ------------------------------------------------------------------
+#  Minimal HTTP server (webhook endpoint)
+# ------------------------------------------------------------------
+class HttpRequest(NamedTuple):
+    method: str
+    path: str
+    query: str
+    headers: dict
+    body: bytes
+
+class HttpServer:
+    # Just enough HTTP/1.1 on asyncio streams to accept webhook deliveries
+    # and local probes without pulling in a web framework.
+    MAX_BODY = 1 << 20
+    MAX_HEADERS = 100
+    READ_TIMEOUT = 30  # seconds per read; also how long an idle keep-alive lasts
+    REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large",
+               431: "Request Header Fields Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.routes: dict = {}
+        self._server = None
+
+    def route(self, method: str, path: str, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("HTTP server listening on %s:%s", self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read(self, read):
+        # A client that stops sending mid-request (or idles) is dropped
+        return await asyncio.wait_for(read, self.READ_TIMEOUT)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await self._read(reader.readline())
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await self._read(reader.readline())
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    if len(headers) >= self.MAX_HEADERS:
+                        await self._respond(writer, 431, "text/plain", b"too many headers", close=True)
+                        return
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > self.MAX_BODY:
+                    await self._respond(writer, 413, "text/plain", b"payload too large", close=True)
+                    break
+                body = await self._read(reader.readexactly(length)) if length else b""
+                path, _, query = target.partition("?")
+                handler = self.routes.get((method, path))
+                if handler is None:
+                    status, content_type, payload = 404, "text/plain", b"not found"
+                else:
+                    try:
+                        status, content_type, payload = await handler(
+                            HttpRequest(method, path, query, headers, body)
+                        )
+                    except Exception as e:
+                        logger.error("HTTP handler %s %s failed: %s", method, path, e)
+                        status, content_type, payload = 500, "text/plain", b"internal error"
+                close = headers.get("connection", "").lower() == "close"
+                await self._respond(writer, status, content_type, payload, close=close)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status: int, content_type: str, payload: bytes, close: bool = False):
+        head = (
+            f"HTTP/1.1 {status} {self.REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n"
         )
+        writer.write(head.encode("latin-1") + payload)
+        await writer.drain()
 
-async def check_join_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    user_id = query.from_user.id
-    await query.answer()
+def from_telegram(request: HttpRequest) -> bool:
+    # Admin commands trust the user id inside the update, so a POST without
+    # the secret could impersonate an admin. validate_config() makes the
+    # secret mandatory in webhook mode; without one, nothing is accepted.
+    token = request.headers.get("x-telegram-bot-api-secret-token", "")
+    return bool(WEBHOOK_SECRET) and hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode())
 
+async def webhook_endpoint(app, request: HttpRequest):
+    if not from_telegram(request):
+        return 403, "text/plain", b"forbidden"
     try:
-        member = await context.bot.get_chat_member(chat_id=CHANNEL_USERNAME, user_id=user_id)
-        if member.status in ["member", "administrator", "creator"]:
-            await query.message.delete()
-            await send_home_menu(update, context)
+        update = Update.de_json(json.loads(request.body), app.bot)
+    except (ValueError, TypeError, KeyError) as e:
+        logger.warning("Rejected malformed webhook payload: %s", e)
+        return 400, "text/plain", b"bad update"
+    await app.update_queue.put(update)
+    return 200, "text/plain", b"ok"
+
+async def metrics_endpoint(request: HttpRequest):
+    return 200, "text/plain; version=0.0.4", metrics.render().encode()
+
+async def profile_endpoint(request: HttpRequest):
+    # Collapsed stacks since start (or the last ?reset=1)
+    reset = "reset=1" in request.query.split("&")
+    return 200, "text/plain", profiler.collapsed(reset=reset).encode()
+
+class Warmup:
+    # Startup jobs run concurrently before the bot takes updates, for at most
+    # WARMUP_TIMEOUT; a job still running then finishes in the background.
+    # /readyz reports every step.
+    def __init__(self):
+        self.steps: dict[str, str] = {}
+        self.ready = False
+        self.seconds: float | None = None
+
+    async def _step(self, name: str, job):
+        self.steps[name] = "running"
+        try:
+            result = await job
+        except Exception as e:
+            self.steps[name] = f"failed: {e}"
+            logger.warning("Warmup step %s failed: %s", name, e)
         else:
-            await query.message.reply_text("❌ You haven't joined the channel yet.")
-    except Exception as e:
-        logger.error("Error checking membership: %s", e)
-        await query.message.reply_text("⚠️ Could not verify your channel join. Please try again later.")
+            self.steps[name] = "ok" if result is None else f"ok: {result}"
 
-# ------------------------------------------------------------------
-#  Menu helpers
-# ------------------------------------------------------------------
-async def send_home_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    home_keyboard = [
-        ["💰 Referral","📚 UAT Preparation"],
-        ["🗂️ Resources", "🏛️ About AAU"],
-        ["🏫 About ASTU", "🏫 About AASTU", "🏥 About SPHMMC"],
-        ["🎓 Other Universities", "ℹ️ About Kimem UAT"]
-    ]
-    reply_markup = ReplyKeyboardMarkup(home_keyboard, resize_keyboard=True)
-    target = update.callback_query or update.message
-    await target.reply_text(
-        "🏠 You are back home. Use the options below:",
-        reply_markup=reply_markup
-    )
+    async def run(self, jobs: dict, timeout: float):
+        started = time.monotonic()
+        tasks = [spawn(self._step(name, job)) for name, job in jobs.items()]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            if pending:
+                logger.warning("Warmup timed out after %.0fs, continuing in the background", timeout)
+        self.seconds = time.monotonic() - started
+        self.ready = True
+        logger.info("Warmup done in %.2fs: %s", self.seconds, self.steps)
 
-# ------------------------------------------------------------------
-#  Referral section
-# ------------------------------------------------------------------
-async def referral_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    user_doc = await ensure_user(user)
+    def probe(self) -> tuple[bool, dict]:
+        return self.ready, {"ready": self.ready, "warmup_seconds": self.seconds, "steps": self.steps}
 
-    invited_count = len(json.loads(user_doc["invited"]))
-    coins = int(user_doc["kimem_coins"])
-    link = user_doc["referral_link"]
+warmup = Warmup()
 
-    caption = (
-        f"Hello {user.first_name};\n"
-        f"--------------------------------\n"
-        f"You have invited: {invited_count} people\n"
-        f"You have: {coins} Kimem Coins\n"
-        f"----------------------------------\n"
-        f"Your invite link:\n{link}\n"
-        f"---------------------------------------\n"
-        f"Get 10 Coins per person you invite\n"
-        f"Collect Kimem Coins and get my paid Telegram Bot and Website Development Courses for free. "
-        f"The coins will be listed after the UAT exam."
-    )
+async def warm_bot_pool(bot, connections: int = 4):
+    # Same idea as the storage warm-up, for the Bot API connection pool
+    await asyncio.gather(*(bot.get_me() for _ in range(connections)))
 
-    keyboard = [
-        [InlineKeyboardButton("Your invites", callback_data="show_invites")],
-        [InlineKeyboardButton("Developer's Channel", url="https://t.me/yosdevhub")],
-    ]
-    with open("img/referral.png", "rb") as img:
-        await update.message.reply_photo(
-            photo=img,
-            caption=caption,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-        )
+async def healthz_endpoint(request: HttpRequest):
+    # Liveness: answering at all means the event loop is turning
+    return 200, "text/plain", b"ok"
 
-async def show_invites_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    user_id = query.from_user.id
-    await query.answer()
+async def readyz_endpoint(probe, request: HttpRequest):
+    ready, report = probe()
+    return (200 if ready else 503), "application/json", json.dumps(report).encode()
 
-    user_doc = await get_user_doc(user_id)
-    invited = json.loads(user_doc["invited"]) if user_doc else []
+def add_health_routes(server: HttpServer, probe=None):
+    server.route("GET", "/healthz", healthz_endpoint)
+    server.route("GET", "/readyz", partial(readyz_endpoint, probe or warmup.probe))
 
-    if not invited:
-        text = "You haven't invited anyone yet."
-    else:
-        lines = [f"📋 Invites list ({len(invited)} total):"]
-        for inv in invited:
-            lines.append(f"• {inv['name']} – {inv['date'][:10]}")
-        text = "\n".join(lines)
+def register_gauges(app):
+    metrics.gauge("kimem_update_queue_depth", "Updates received but not yet picked up",
+                  lambda: app.update_queue.qsize())
+    metrics.gauge("kimem_updates_in_flight", "Updates currently being handled",
+                  lambda: app.update_processor.current_concurrent_updates)
+    metrics.gauge("kimem_send_queue_depth", "Bot API calls waiting in the send scheduler",
+                  send_scheduler.queue_depth)
+    metrics.gauge("kimem_background_tasks", "Fire-and-forget tasks still running",
+                  lambda: len(_background_tasks))
+    metrics.gauge("kimem_user_cache", "User document cache stats", user_cache.stats, label="stat")
+    metrics.gauge("kimem_membership_cache", "Channel membership cache stats", membership_cache.stats, label="stat")
+    metrics.gauge("kimem_cache_bus", "Cache events between worker processes", cache_bus.stats, label="stat")
+    metrics.gauge("kimem_tap_dedup", "Duplicate tap suppression stats", tap_dedup.stats, label="stat")
+    metrics.gauge("kimem_user_state", "Per-user state store stats", user_state.stats, label="stat")
+    metrics.gauge("kimem_content_index", "Content index stats", content_index.stats, label="stat")
+
+async def start_metrics_server(probe=None) -> HttpServer | None:
+    if not METRICS_PORT:
+        return None
+    # Receiver on METRICS_PORT, worker i on METRICS_PORT + 1 + i
+    port = METRICS_PORT + (cache_bus.worker_index + 1 if cache_bus.clustered else 0)
+    server = HttpServer(METRICS_LISTEN, port)
+    server.route("GET", "/metrics", metrics_endpoint)
+    add_health_routes(server, probe)
+    if profiler:
+        server.route("GET", "/debug/profile", profile_endpoint)
+    await server.start()
+    return server
 
-    keyboard = [[InlineKeyboardButton("⬅ Go Back", callback_data="referral_back")]]
+@contextlib.asynccontextmanager
+async def running_application(app):
+    # What run_polling does around the updater, for apps fed by us
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
     try:
-        await query.message.edit_caption(caption=text, reply_markup=InlineKeyboardMarkup(keyboard))
-    except Exception as e:
-        logger.error("Failed to edit caption: %s", e)
-        await query.message.reply_text(text)
+        yield app
+    finally:
+        await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
 
-async def referral_back_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user = query.from_user
-    user_doc = await get_user_doc(user.id)
+def stop_on_signals() -> asyncio.Event:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    return stop
 
-    invited_count = len(json.loads(user_doc["invited"]))
-    coins = int(user_doc["kimem_coins"])
-    link = user_doc["referral_link"]
+async def set_webhook(bot):
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=min(MAX_CONCURRENT_UPDATES, 100),
+        )
+    else:
+        logger.info("WEBHOOK_URL not set – accepting local POSTs on %s only", WEBHOOK_PATH)
 
-    caption = (
-        f"Hello {user.first_name};\n"
-        f"--------------------------------\n"
-        f"You have invited: {invited_count} people\n"
-        f"You have: {coins} Kimem Coins\n"
-        f"----------------------------------\n"
-        f"Your invite link:\n{link}\n"
-        f"---------------------------------------\n"
-        f"Get 10 Coins per person you invite\n"
-        f"Collect Kimem Coins and get my paid Telegram Bot and Website Development Courses for free. "
-        f"The coins will be listed after the UAT exam."
-    )
+async def serve_webhook(app):
+    server = HttpServer(WEBHOOK_LISTEN, WEBHOOK_PORT)
+    server.route("POST", WEBHOOK_PATH, partial(webhook_endpoint, app))
+    add_health_routes(server)
 
-    keyboard = [
-        [InlineKeyboardButton("Your invites", callback_data="show_invites")],
-        [InlineKeyboardButton("Developer's Channel", url="https://t.me/yosdevhub")],
-    ]
+    # Listen before warming up: probes see /readyz go from 503 to 200, and
+    # deliveries that arrive meanwhile wait in update_queue for app.start()
+    await server.start()
     try:
-        await query.message.edit_caption(caption=caption, reply_markup=InlineKeyboardMarkup(keyboard))
-    except Exception as e:
-        logger.error("Failed to go back to referral screen: %s", e)
-        await query.message.reply_text(caption)
+        async with running_application(app):
+            await set_webhook(app.bot)
+            await stop_on_signals().wait()
+    finally:
+        await server.stop()
 
 # ------------------------------------------------------------------
-#  Generic menu handlers
+#  Multi-process mode (WORKERS > 1)
 # ------------------------------------------------------------------
-async def uat_preparation_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    set_user_state(context, "HOME")
-    keyboard = [
-        ["❓ What is UAT?", "🏛 AAU UAT"],
-        ["🏫 AASTU & ASTU UAT", "🏥 SPHMMC Entrance"],
-        ["⬅ Back", "🏠Home"]
-    ]
-    await update.message.reply_text(
-        "📘 UAT Preparation Section\nChoose the university or topic you want to explore:",
-        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    )
+def update_owner(data: dict) -> int:
+    # The user an update is about. Private chats have chat id == user id,
+    # so routing by user keeps each chat on one worker and in order.
+    for kind, body in data.items():
+        if not isinstance(body, dict):
+            continue
+        if kind == "chat_member":
+            # The member who joined or left, not the admin who acted
+            body = body.get("new_chat_member") or body
+        who = body.get("from") or body.get("user") or body.get("chat") or {}
+        if "id" in who:
+            return who["id"]
+    return 0
 
-async def resources_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    set_user_state(context, "HOME")
-    keyboard = [
-        ["🎯 Kimem Short Notes","📘 Text Books"],
-        ["📚 SAT Collection","🌐 Websites"],
-        ["⬅ Back", "🏠Home"]
-    ]
-    await update.message.reply_text(
-        "🗂️ Resources Section:\nSelect a category to explore useful learning materials.",
-        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    )
+class LocalChannel:
+    # Stand-in for a shared message channel (Redis, NATS, ...) on one machine:
+    # an inbox queue per worker carrying updates and cache events in order,
+    # and one bus queue from the workers back to the receiver.
+    def __init__(self, ctx, workers: int):
+        self.inboxes = [ctx.Queue() for _ in range(workers)]
+        self.bus = ctx.Queue()
+        self.dispatched = [0] * workers
+        self.relayed = 0
 
-async def about_university_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, university: str):
-    set_user_state(context, "HOME")
-    keyboard = [
-        [f"🏫 {university} Overview", f"🏢 {university} Departments"],
-        [f"📍 {university} Campuses", f"🎒 Life In {university}"],
-        [f"🎓 {university} After Graduation", f"🌐{university} Websites"],
-        ["⬅ Back", "🏠Home"]
-    ]
-    await update.message.reply_text(
-        f"🏛️ About {university} Section:\nSelect an option to learn more.",
-        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    )
+    def dispatch(self, data: dict):
+        index = abs(update_owner(data)) % len(self.inboxes)
+        self.inboxes[index].put(("update", data))
+        self.dispatched[index] += 1
 
-async def other_universities_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    set_user_state(context, "HOME")
-    keyboard = [
-        ["🏫 Bahiradar University"],
-        ["🏫 Haramaya University"],
-        ["🏫 Jimma University"],
-        ["⬅ Back", "🏠Home"]
-    ]
-    await update.message.reply_text(
-        "🎓 Other Universities Section:\nSelect a university to learn more.",
-        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    )
+    def fan_out(self, origin: int, event: tuple):
+        for index, inbox in enumerate(self.inboxes):
+            if index != origin:
+                inbox.put(("cache", event))
+        self.relayed += 1
 
-async def about_kimem_uat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db_channel = DB_CHANNEL_USERNAME
-    if not db_channel:
-        await update.message.reply_text("⚠️ Channel not configured.")
-        return
+    def close(self):
+        for inbox in self.inboxes:
+            inbox.put(("stop", None))
+        self.bus.put((None, None))
+
+    def backlog(self) -> dict:
+        try:
+            return {str(i): inbox.qsize() for i, inbox in enumerate(self.inboxes)}
+        except NotImplementedError:   # macOS
+            return {}
+
+    def stats(self) -> dict:
+        return {"dispatched": sum(self.dispatched), "relayed": self.relayed,
+                **{f"worker_{i}": n for i, n in enumerate(self.dispatched)}}
+
+async def serve_worker(app, inbox):
+    loop = asyncio.get_running_loop()
+    async with running_application(app):
+        logger.info("Worker %d/%d ready", cache_bus.worker_index, cache_bus.workers)
+        while True:
+            kind, payload = await loop.run_in_executor(None, inbox.get)
+            if kind == "update":
+                await app.update_queue.put(Update.de_json(payload, app.bot))
+            elif kind == "cache":
+                cache_bus.apply(payload)
+            elif kind == "stop":
+                break
+
+def run_worker(index: int, workers: int, inbox, bus):
+    # Runs in a spawned process; the receiver decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    cache_bus.connect(index, workers, bus)
+    send_scheduler.share_global(workers)
+    asyncio.run(serve_worker(build_application(fed_externally=True), inbox))
+
+async def relay_cache_events(channel: LocalChannel):
+    loop = asyncio.get_running_loop()
+    while True:
+        origin, event = await loop.run_in_executor(None, channel.bus.get)
+        if origin is None:
+            return
+        channel.fan_out(origin, event)
+
+async def poll_into(bot, channel: LocalChannel):
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=25, allowed_updates=Update.ALL_TYPES)
+        except RetryAfter as e:
+            await asyncio.sleep(retry_after_seconds(e))
+            continue
+        except NetworkError as e:
+            logger.warning("getUpdates failed: %s", e)
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            channel.dispatch(update.to_dict())
+            offset = update.update_id + 1
+
+async def cluster_webhook_endpoint(channel: LocalChannel, request: HttpRequest):
+    # Like webhook_endpoint, but the raw JSON goes straight to a worker
+    if not from_telegram(request):
+        return 403, "text/plain", b"forbidden"
     try:
-        await context.bot.copy_message(
-            chat_id=update.effective_chat.id,
-            from_chat_id=db_channel,
-            message_id=6
-        )
-    except Exception as e:
-        logger.error("Error copying message: %s", e)
-        await update.message.reply_text("⚠️ Could not retrieve info. Please try again later.")
+        data = json.loads(request.body)
+    except ValueError as e:
+        logger.warning("Rejected malformed webhook payload: %s", e)
+        return 400, "text/plain", b"bad update"
+    if not isinstance(data, dict):
+        return 400, "text/plain", b"bad update"
+    channel.dispatch(data)
+    return 200, "text/plain", b"ok"
 
-# ------------------------------------------------------------------
-#  UAT sub-menu handlers
-# ------------------------------------------------------------------
-async def uat_university_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, university: str):
-    set_user_state(context, "UAT_PREPARATION")
-    keyboard = [
-        [f"📘 {university} Last Year UAT", f"📖 {university} Model UAT"],
-        [f"📚 {university} UAT Overview", f"❓ {university} UAT FAQ"],
-        [f"📝 How to Prepare For {university}"],
-        ["⬅ Back", "🏠Home"]
-    ]
-    await update.message.reply_text(
-        f"🏛 {university} UAT Section:\nChoose an option to explore:",
-        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    )
+async def supervise(ctx, procs: list, channel: LocalChannel):
+    # Restart a crashed worker on the same inbox; its partition waits meanwhile
+    while True:
+        await asyncio.sleep(2)
+        for index, proc in enumerate(procs):
+            if not proc.is_alive():
+                logger.error("Worker %d exited with %s, restarting", index, proc.exitcode)
+                procs[index] = start_worker(ctx, index, channel)
 
-async def what_is_uat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    set_user_state(context, "UAT_PREPARATION")
-    kb = [
-        ["📖 UAT Overview"],
-        ["❓ Frequently Asked"],
-        ["⬅ Back", "🏠Home"]
-    ]
-    await update.message.reply_text(
-        "Choose an option to learn about UAT:",
-        reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
+def start_worker(ctx, index: int, channel: LocalChannel):
+    proc = ctx.Process(
+        target=run_worker, args=(index, len(channel.inboxes), channel.inboxes[index], channel.bus),
+        name=f"kimem-worker-{index}", daemon=True,
     )
+    proc.start()
+    return proc
 
-async def aastu_astu_uat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    set_user_state(context, "UAT_PREPARATION")
-    keyboard = [
-        ["📘 AASTU & ASTU Last Year UAT", "📖 AASTU & ASTU Model UAT"],
-        ["📚 AASTU & ASTU UAT Overview","❓ AASTU & ASTU UAT FAQ"],
-        ["📝 How to Prepare For AASTU & ASTU"],
-        ["⬅ Back", "🏠Home"]
-    ]
-    await update.message.reply_text(
-        "🏫 AASTU & ASTU UAT Section:\nChoose an option to explore:",
-        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    )
+async def serve_cluster(workers: int):
+    # The receiver only moves bytes: it takes updates (polling or webhook),
+    # hands each to the worker owning its user and relays cache events.
+    ctx = multiprocessing.get_context("spawn")
+    channel = LocalChannel(ctx, workers)
+    procs = [start_worker(ctx, index, channel) for index in range(workers)]
+    metrics.gauge("kimem_cluster", "Updates dispatched per worker and cache events relayed",
+                  channel.stats, label="stat")
+    metrics.gauge("kimem_worker_backlog", "Updates waiting in each worker's inbox",
+                  channel.backlog, label="worker")
 
-async def sphmmc_entrance_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    set_user_state(context, "UAT_PREPARATION")
-    keyboard = [
-        ["📘 SPHMMC Last Year Exam", "📖 SPHMMC Model Exam"],
-        ["📚 SPHMMC Exam Overview", "❓ SPHMMC Exam FAQ"],
-        ["📝 How to Prepare For SPHMMC"],
-        ["⬅ Back", "🏠Home"]
-    ]
-    await update.message.reply_text(
-        "🏥 SPHMMC Entrance Section:\nChoose an option to explore:",
-        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    )
+    def probe():
+        # Ready while every worker process is up (supervise() restarts them)
+        alive = [proc.is_alive() for proc in procs]
+        return all(alive), {"ready": all(alive), "workers": alive}
 
-async def universal_back_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    prev = context.user_data.get("prev_menu")
-    if prev == "HOME":
-        await send_home_menu(update, context)
-    elif prev == "UAT_PREPARATION":
-        await uat_preparation_handler(update, context)
-    else:
-        await send_home_menu(update, context)
+    metrics_server = await start_metrics_server(probe)
+
+    bot_kwargs = {"base_url": f"{BOT_API_URL.rstrip('/')}/bot"} if BOT_API_URL else {}
+    bot = Bot(BOT_TOKEN, **bot_kwargs)
+    tasks = [asyncio.create_task(relay_cache_events(channel)), asyncio.create_task(supervise(ctx, procs, channel))]
+    server = None
+    async with bot:
+        if BOT_MODE == "webhook":
+            server = HttpServer(WEBHOOK_LISTEN, WEBHOOK_PORT)
+            server.route("POST", WEBHOOK_PATH, partial(cluster_webhook_endpoint, channel))
+            add_health_routes(server, probe)
+            await server.start()
+            await set_webhook(bot)
+        else:
+            tasks.append(asyncio.create_task(poll_into(bot, channel)))
+        logger.info("Receiver running with %d workers (%s)", workers, BOT_MODE)
+        try:
+            await stop_on_signals().wait()
+        finally:
+            if server:
+                await server.stop()
+            for task in tasks[1:]:
+                task.cancel()
+            channel.close()
+            await tasks[0]
+            for proc in procs:
+                await asyncio.to_thread(proc.join, 30)
+                if proc.is_alive():
+                    proc.terminate()
+            if metrics_server:
+                await metrics_server.stop()
 
 # ------------------------------------------------------------------
-#  Forward-map generators (unchanged except async)
+#  Legacy schema migration (python "bot .py" migrate)
 # ------------------------------------------------------------------
-def make_forwarder(channel_key: str, msg_id: int):
-    env_key = f"DB_{channel_key}_CHANNEL_USERNAME"
-    channel = os.getenv(env_key)
-    if not channel:
-        logger.warning("Env var %s not set – skipping some handlers", env_key)
-        return None
+async def migrate_users(*, dry_run: bool, concurrency: int, page_size: int, restart: bool):
+    # Streams every user document and upgrades the legacy ones (string
+    # kimem_coins, JSON invited) to integer counters plus invite records,
+    # up to `concurrency` documents at a time. Upgrading is idempotent and the
+    # cursor is checkpointed after each page, so an interrupted run simply
+    # continues; --dry-run only counts what would change. Balances are kept
+    # as they are; documents whose coins differ from REFERRAL_REWARD per
+    # invite are logged so they can be checked. Afterwards referral credits
+    # that never finished, including invites recorded while the referrer was
+    # still legacy, are reconciled.
+    path = Path(MIGRATE_CHECKPOINT_PATH)
+    state = {} if restart or dry_run else read_json_store(path)
+    state = {"cursor": None, "scanned": 0, "legacy": 0, "mismatched": 0, "migrated": 0, "failed": 0, **state}
+    if state["cursor"]:
+        logger.info("Resuming migration after user %s", state["cursor"])
+    total = await user_store.count_users()
+    sem = asyncio.Semaphore(concurrency)
+    started, scanned_at_start = time.monotonic(), state["scanned"]
 
-    async def _handler(update: Update, _: ContextTypes.DEFAULT_TYPE):
-        try:
-            await update.get_bot().copy_message(
-                chat_id=update.effective_chat.id,
-                from_chat_id=channel,
-                message_id=msg_id
-            )
-        except Exception as e:
-            logger.error("Error forwarding %s/%s: %s", channel_key, msg_id, e)
-            await update.message.reply_text("⚠️ Could not retrieve info.")
-    return _handler
+    async def upgrade(doc: dict):
+        async with sem:
+            try:
+                await user_store.upgrade_legacy(doc["$id"])
+                state["migrated"] += 1
+            except Exception as e:
+                state["failed"] += 1
+                logger.error("Failed to migrate user %s: %s", doc["$id"], e)
 
-def make_multi_forwarder(entries):
-    channels = {}
-    for key, _ in entries:
-        env_key = f"DB_{key}_CHANNEL_USERNAME"
-        channels[key] = os.getenv(env_key)
-        if channels[key] is None:
-            logger.warning("Missing env var %s – skipped multi-forward", env_key)
-            return None
+    try:
+        async for page in user_store.iter_user_pages(after=state["cursor"], page_size=page_size):
+            legacy = [doc for doc in page if is_legacy_doc(doc)]
+            state["scanned"] += len(page)
+            state["legacy"] += len(legacy)
+            for doc in legacy:
+                invites = len(json.loads(doc.get("invited") or "[]"))
+                if user_coins(doc) != REFERRAL_REWARD * invites:
+                    state["mismatched"] += 1
+                    logger.warning("User %s has %d coins for %d invites (expected %d); kept as is",
+                                   doc["$id"], user_coins(doc), invites, REFERRAL_REWARD * invites)
+            if not dry_run:
+                await asyncio.gather(*(upgrade(doc) for doc in legacy))
+                state["cursor"] = page[-1]["$id"]
+                write_json_store(path, state)
+            elapsed = time.monotonic() - started
+            rate = (state["scanned"] - scanned_at_start) / elapsed if elapsed > 0 else 0.0
+            eta = max(0, total - state["scanned"]) / rate if rate else None
+            logger.info(
+                "Migration: %d/%d scanned, %d legacy, %d migrated, %d failed · %.0f docs/s · ETA %s",
+                state["scanned"], total, state["legacy"], state["migrated"], state["failed"],
+                rate, format_duration(eta),
+            )
+        if not dry_run:
+            repaired = await user_store.reconcile_credits(REFERRAL_REWARD)
+            logger.info("Reconciled unfinished referral credits for %d referrers", len(repaired))
+    finally:
+        await user_store.close()
 
-    async def _handler(update: Update, _: ContextTypes.DEFAULT_TYPE):
-        try:
-            for key, msg_id in entries:
-                await update.get_bot().copy_message(
-                    chat_id=update.effective_chat.id,
-                    from_chat_id=channels[key],
-                    message_id=msg_id
-                )
-        except Exception as e:
-            logger.error("Multi-forward failed: %s", e)
-            await update.message.reply_text("⚠️ Could not retrieve info.")
-    return _handler
+    if dry_run:
+        logger.info("Dry run: %d of %d documents need migrating, %d with coins not matching their invites",
+                    state["legacy"], state["scanned"], state["mismatched"])
+    else:
+        path.unlink(missing_ok=True)
+        if state["failed"]:
+            # Failed documents are still legacy; a fresh run only rewrites those
+            logger.warning("Migration finished with %d failures; run it again to retry them", state["failed"])
+        else:
+            logger.info("Migration complete: %d documents migrated, %d with coins not matching their invites",
+                        state["migrated"], state["mismatched"])
 
 # ------------------------------------------------------------------
 #  Main entry-point
 # ------------------------------------------------------------------
-def main():
-    if not BOT_TOKEN or not CHANNEL_USERNAME:
-        logger.error("Missing .env values. BOT_TOKEN and CHANNEL_USERNAME are required.")
+async def log_cache_stats():
+    while True:
+        await asyncio.sleep(CACHE_STATS_INTERVAL)
+        logger.info("User cache: %s", user_cache.stats())
+        logger.info("Membership cache: %s", membership_cache.stats())
+        logger.info("Send scheduler: %s", send_scheduler.stats())
+        logger.info("Content index: %s", content_index.stats())
+        logger.info("User state: %s", user_state.stats())
+        logger.info("Duplicate taps: %s", tap_dedup.stats())
+
+async def reindex_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    if not content_index.enabled:
+        await update.message.reply_text("⚠️ CONTENT_MIRROR_CHAT_ID is not configured.")
         return
+    await update.message.reply_text("🔄 Re-indexing content...")
+    indexed = await content_index.warm(context.bot, force=True)
+    await update.message.reply_text(f"✅ Indexed {indexed} messages.")
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+async def on_startup(app):
+    # Metrics / health first so /readyz is reachable during the warm-up
+    app.bot_data["metrics_server"] = await start_metrics_server()
+    app.bot_data["stats_task"] = asyncio.create_task(log_cache_stats())
+    user_state.start()
+    app.bot_data["leaderboard_task"] = spawn(leaderboard.rebuild(user_store))
+    checkpoint = read_json_store(Path(BROADCAST_CHECKPOINT_PATH)) if cache_bus.leader else None
+    if checkpoint:
+        logger.warning("Interrupted broadcast found (cursor %s); /broadcast resume to continue",
+                       checkpoint.get("cursor"))
+    if profiler:
+        profiler.start()
+    if DB_CHANNEL_USERNAME:
+        content_index.track(DB_CHANNEL_USERNAME, ABOUT_KIMEM_MSG_ID)
+
+    # Updates are only taken once this returns (or times out). In
+    # multi-process mode only worker 0 uploads and indexes content; the
+    # others receive the results over the cache bus.
+    jobs = {"storage": user_store.warm(APPWRITE_CONCURRENCY), "bot_api": warm_bot_pool(app.bot)}
+    if cache_bus.leader:
+        jobs["media"] = warm_media(app.bot, CONTENT_MIRROR_CHAT_ID)
+        jobs["content_index"] = content_index.warm(app.bot)
+    await warmup.run(jobs, WARMUP_TIMEOUT)
+    if cache_bus.leader and RECONCILE_INTERVAL:
+        app.bot_data["reconcile_task"] = asyncio.create_task(reconcile_credits_periodically())
+
+async def on_shutdown(app):
+    for name in ("stats_task", "leaderboard_task", "reconcile_task"):
+        task = app.bot_data.pop(name, None)
+        if task:
+            task.cancel()
+    broadcast = app.bot_data.pop("broadcast", None)
+    if broadcast and not broadcast.task.done():
+        # The last finished page is already checkpointed
+        broadcast.task.cancel()
+    server = app.bot_data.pop("metrics_server", None)
+    if server:
+        await server.stop()
+    if profiler:
+        profiler.stop()
+    logger.info("User cache: %s", user_cache.stats())
+    await user_state.close()
+    await user_store.close()
+
+def build_application(fed_externally: bool = BOT_MODE == "webhook"):
+    # fed_externally: updates arrive on app.update_queue from our own webhook
+    # server or the multi-process receiver instead of PTB's updater
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .rate_limiter(send_scheduler)
+    )
+    if BOT_API_URL:
+        builder = builder.base_url(f"{BOT_API_URL.rstrip('/')}/bot")
+    if fed_externally:
+        builder = builder.updater(None).concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    app = builder.build()
 
     # Command & callback handlers
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("reindex", reindex_command))
+    app.add_handler(CommandHandler("broadcast", broadcast_command))
+    app.add_handler(CommandHandler("top", top_command))
     app.add_handler(CallbackQueryHandler(continue_handler, pattern="^continue$"))
     app.add_handler(CallbackQueryHandler(check_join_handler, pattern="^check_join$"))
-    app.add_handler(CallbackQueryHandler(show_invites_handler, pattern="^show_invites$"))
+    app.add_handler(CallbackQueryHandler(show_invites_handler, pattern="^show_invites(:|$)"))
     app.add_handler(CallbackQueryHandler(referral_back_handler, pattern="^referral_back$"))
+    app.add_handler(CallbackQueryHandler(leaderboard_handler, pattern="^leaderboard$"))
+    app.add_handler(ChatMemberHandler(channel_member_handler, ChatMemberHandler.CHAT_MEMBER))
+    app.add_handler(ChatMemberHandler(bot_status_handler, ChatMemberHandler.MY_CHAT_MEMBER))
 
-    # Text message handlers
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^📚 UAT Preparation$"), uat_preparation_handler))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^🏠Home$"), send_home_menu))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^🗂️ Resources$"), resources_handler))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^💰 Referral$"), referral_handler))
-
-    # University about handlers
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^🏛️ About AAU$"), lambda u, c: about_university_handler(u, c, "AAU")))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^🏫 About ASTU$"), lambda u, c: about_university_handler(u, c, "ASTU")))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^🏫 About AASTU$"), lambda u, c: about_university_handler(u, c, "AASTU")))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^🏥 About SPHMMC$"), lambda u, c: about_university_handler(u, c, "SPHMMC")))
-
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^🎓 Other Universities$"), other_universities_handler))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^ℹ️ About Kimem UAT$"), about_kimem_uat_handler))
-
-    # UAT preparation handlers
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^❓ What is UAT\?$"), what_is_uat_handler))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^🏛 AAU UAT$"), lambda u, c: uat_university_handler(u, c, "AAU")))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^🏛 ASTU UAT$"), lambda u, c: uat_university_handler(u, c, "ASTU")))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^🏛 AASTU UAT$"), lambda u, c: uat_university_handler(u, c, "AASTU")))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^🏫 AASTU & ASTU UAT$"), aastu_astu_uat_handler))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^🏥 SPHMMC Entrance$"), sphmmc_entrance_handler))
-
-    # Back handler
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex(PATTERN_BACK), universal_back_handler))
-
-    # Register forward-map handlers
-    for text, (key, mid) in FORWARD_MAP.items():
-        handler_fn = make_forwarder(key, mid)
-        if handler_fn:
-            app.add_handler(MessageHandler(filters.TEXT & filters.Regex(f"^{text}$"), handler_fn))
+    # Text buttons: one handler, exact-text dict dispatch
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_router))
+    TEXT_ROUTES.update(build_text_routes())
 
-    for button_text, entries in MULTI_FORWARD_MAP.items():
-        handler_fn = make_multi_forwarder(entries)
-        if handler_fn:
-            app.add_handler(MessageHandler(filters.TEXT & filters.Regex(f"^{button_text}$"), handler_fn))
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            # Duplicates are dropped before they reach the handler metrics
+            handler.callback = tap_dedup.wrap(instrument_handler(handler.callback.__name__, handler.callback))
+    register_gauges(app)
+    return app
+
+def validate_config(for_bot: bool = True) -> list[str]:
+    # Everything that would otherwise surface as a crash or a silently
+    # missing button after the first users arrive. for_bot=False checks only
+    # what the migration needs (storage).
+    errors = list(CONFIG_ERRORS)
+    if STORAGE_BACKEND == "appwrite":
+        required = {
+            "APPWRITE_PROJECT_ID": APPWRITE_PROJECT, "APPWRITE_API_KEY": APPWRITE_KEY,
+            "APPWRITE_DATABASE_ID": APPWRITE_DB, "APPWRITE_COLLECTION_ID": APPWRITE_COLL,
+            "APPWRITE_INVITES_COLLECTION_ID": APPWRITE_INVITES,
+        }
+        errors += [f"{name} is required with STORAGE_BACKEND=appwrite" for name, value in required.items() if not value]
+        if not APPWRITE_ENDPOINT.startswith(("http://", "https://")):
+            errors.append(f"APPWRITE_ENDPOINT must be an http(s) URL, got {APPWRITE_ENDPOINT!r}")
+    elif STORAGE_BACKEND != "sqlite":
+        errors.append(f"STORAGE_BACKEND must be appwrite or sqlite, got {STORAGE_BACKEND!r}")
+    for name, value in (("APPWRITE_CONCURRENCY", APPWRITE_CONCURRENCY),
+                        ("APPWRITE_MAX_CONNECTIONS", APPWRITE_MAX_CONNECTIONS)):
+        if value < 1:
+            errors.append(f"{name} must be at least 1")
+    if not for_bot:
+        return errors
+
+    if not BOT_TOKEN:
+        errors.append("BOT_TOKEN is required")
+    elif not re.fullmatch(r"\d+:[\w-]+", BOT_TOKEN):
+        errors.append("BOT_TOKEN does not look like a bot token (<id>:<secret>)")
+    if not CHANNEL_USERNAME:
+        errors.append("CHANNEL_USERNAME is required")
+    elif not re.fullmatch(r"@\w{4,}", CHANNEL_USERNAME):
+        # It also builds the public t.me link of the "Join Channel" button
+        errors.append(f"CHANNEL_USERNAME must be the channel's @name, got {CHANNEL_USERNAME!r}")
+    bad_admins = [x for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip() and not x.strip().isdigit()]
+    if bad_admins:
+        errors.append(f"ADMIN_IDS must be comma-separated user ids, got {bad_admins!r}")
+
+    # Every content button needs its source channel; a missing one used to
+    # only drop the button with a warning
+    for key in sorted({key for key, _ in FORWARD_MAP.values()}
+                      | {key for entries in MULTI_FORWARD_MAP.values() for key, _ in entries}):
+        if not os.getenv(f"DB_{key}_CHANNEL_USERNAME"):
+            errors.append(f"DB_{key}_CHANNEL_USERNAME is required by the content buttons")
+    if CONTENT_MIRROR_CHAT_ID and not re.fullmatch(r"-?\d+|@\w+", CONTENT_MIRROR_CHAT_ID):
+        errors.append(f"CONTENT_MIRROR_CHAT_ID must be a chat id or @name, got {CONTENT_MIRROR_CHAT_ID!r}")
+    errors += [f"{path} is missing" for path in (COVER_IMAGE, REFERRAL_IMAGE) if not Path(path).is_file()]
+
+    if BOT_MODE not in ("polling", "webhook"):
+        errors.append(f"BOT_MODE must be polling or webhook, got {BOT_MODE!r}")
+    if not WEBHOOK_PATH.startswith("/"):
+        errors.append(f"WEBHOOK_PATH must start with /, got {WEBHOOK_PATH!r}")
+    if WEBHOOK_URL and not WEBHOOK_URL.startswith("https://"):
+        errors.append("WEBHOOK_URL must be an https URL")
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        errors.append("WEBHOOK_SECRET is required with BOT_MODE=webhook")
+    elif WEBHOOK_SECRET and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+        errors.append("WEBHOOK_SECRET may only contain A-Z, a-z, 0-9, _ and - (at most 256)")
+    if BOT_API_URL and not BOT_API_URL.startswith(("http://", "https://")):
+        errors.append(f"BOT_API_URL must be an http(s) URL, got {BOT_API_URL!r}")
+
+    for name, value in (("WORKERS", WORKERS), ("MAX_CONCURRENT_UPDATES", MAX_CONCURRENT_UPDATES),
+                        ("BROADCAST_WORKERS", BROADCAST_WORKERS), ("BROADCAST_PAGE_SIZE", BROADCAST_PAGE_SIZE),
+                        ("STATE_CACHE_SIZE", STATE_CACHE_SIZE), ("USER_CACHE_SIZE", USER_CACHE_SIZE)):
+        if value < 1:
+            errors.append(f"{name} must be at least 1")
+    for name, value in (("SEND_GLOBAL_RATE", SEND_GLOBAL_RATE), ("SEND_CHAT_RATE", SEND_CHAT_RATE),
+                        ("SEND_GROUP_RATE", SEND_GROUP_RATE), ("STATE_FLUSH_INTERVAL", STATE_FLUSH_INTERVAL)):
+        if value <= 0:
+            errors.append(f"{name} must be greater than 0")
+    if SEND_CHAT_BURST < 1:
+        errors.append("SEND_CHAT_BURST must be at least 1")
+    if BOT_MODE == "webhook" and not 1 <= WEBHOOK_PORT <= 65535:
+        errors.append(f"PORT must be between 1 and 65535, got {WEBHOOK_PORT}")
+    # The receiver uses METRICS_PORT, worker i METRICS_PORT + 1 + i
+    if METRICS_PORT and METRICS_PORT + (WORKERS if WORKERS > 1 else 0) > 65535:
+        errors.append(f"METRICS_PORT {METRICS_PORT} leaves no room for {WORKERS} workers")
+    return errors
+
+def exit_on_config_errors(errors: list[str]):
+    if errors:
+        for error in errors:
+            logger.error("Config: %s", error)
+        logger.error("Refusing to start with %d configuration error(s)", len(errors))
+        sys.exit(1)
 
-    logger.info("Bot running...")
-    app.run_polling()
+def main():
+    exit_on_config_errors(validate_config())
+
+    if WORKERS > 1:
+        logger.info("Bot running (%d worker processes)...", WORKERS)
+        asyncio.run(serve_cluster(WORKERS))
+        return
+
+    app = build_application()
+    if BOT_MODE == "webhook":
+        logger.info("Bot running (webhook)...")
+        asyncio.run(serve_webhook(app))
+    else:
+        logger.info("Bot running...")
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+
+def cli():
+    parser = argparse.ArgumentParser(prog='python "bot .py"', description="Kimem UAT Telegram bot")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("run", help="run the bot (default)")
+    migrate = commands.add_parser("migrate", help="upgrade legacy user documents to the counter schema")
+    migrate.add_argument("--dry-run", action="store_true", help="only count documents that need migrating")
+    migrate.add_argument("--concurrency", type=int, default=MIGRATE_CONCURRENCY)
+    migrate.add_argument("--page-size", type=int, default=100)
+    migrate.add_argument("--restart", action="store_true", help="ignore the checkpoint and start over")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        exit_on_config_errors(validate_config(for_bot=False))
+        asyncio.run(migrate_users(
+            dry_run=args.dry_run, concurrency=args.concurrency,
+            page_size=args.page_size, restart=args.restart,
+        ))
+    else:
+        main()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    cli()
\ No newline at end of file